@@ -2,14 +2,19 @@ import os
 import uuid
 import json
 import datetime
+import itertools
+import hashlib
+import tempfile
+import time
+import atexit
+import threading
 import duckdb
-import boto3
-import botocore
 import psycopg2
+import psycopg2.pool
 from psycopg2 import Error
 import sys
 sys.path.append('../')
-from library import Library
+from library import Library, COMPRESSION
 import logging
 
 class Collector:
@@ -41,129 +46,465 @@ class Collector:
             return os.environ[v]
 
     def add_meta(self,data):
-        new = []
         for i in data:
             i['_tenancy'] = self.lib.config['tenancy']
             i['_upload_timestamp'] = self.upload_timestamp
             i['_upload_id'] = self.upload_id
-            new.append(i)
-        return new
-    
-    def store(self,tag,data1):
-        if len(data1) > 0:
-            logging.info(f"Storing {tag} of {len(data1)} records")
-
-            data = self.add_meta(data1)
-
-            self.store_file(tag,data)
-            self.lib.backup_to_s3(
-                self.lib.variables(tag,self.lib.config['STORE_FILE']),
-                self.lib.config['STORE_AWS_S3_BUCKET'],
-                self.lib.variables(tag,self.lib.config['STORE_AWS_S3_BACKUP'])
-            )
-            self.upload_to_s3(data,tag,self.lib.config['STORE_AWS_S3_KEY'])
-            self.store_postgres(tag,data)
-            self.store_duckdb(tag,data)
-        else:
+            yield i
+
+    def state(self,tag):
+        # == state (like watermarks) is kept per tag and tenancy, locally and in S3 when a bucket is defined
+        target = self.lib.variables(tag,self.lib.config['STORE_STATE'])
+        if not os.path.exists(target) and self.lib.config['STORE_AWS_S3_BUCKET'] != '':
+            os.makedirs(os.path.dirname(os.path.abspath(target)),exist_ok = True)
+            self.lib.download_from_s3(self.lib.config['STORE_AWS_S3_BUCKET'],self.lib.variables(tag,self.lib.config['STORE_AWS_S3_STATE']),target = 'file',parameter = target)
+        if os.path.exists(target):
+            with open(target,'rt',encoding='UTF-8') as q:
+                return json.load(q)
+        return {}
+
+    def save_state(self,tag,state):
+        target = self.lib.variables(tag,self.lib.config['STORE_STATE'])
+        os.makedirs(os.path.dirname(os.path.abspath(target)),exist_ok = True)
+        with open(target,'wt',encoding='UTF-8') as q:
+            json.dump(state,q,default=str)
+        if self.lib.config['STORE_AWS_S3_BUCKET'] != '':
+            self.lib.upload_to_s3(target,self.lib.config['STORE_AWS_S3_BUCKET'],self.lib.variables(tag,self.lib.config['STORE_AWS_S3_STATE']))
+
+    def watermark(self,tag,days = 7):
+        # == the watermark of the last run, or None when we need a full pull - because we were asked to, because
+        # == there is no previous data set to merge into, or because the last full pull is more than `days` old.
+        if os.environ.get('COLLECTOR_FULL_REFRESH','false').lower() == 'true':
+            return None
+        state = self.state(tag)
+        if state.get('watermark') is None or state.get('full') is None:
+            return None
+        if datetime.datetime.fromisoformat(state['full']) < self.datetime - datetime.timedelta(days = days):
+            logging.info(f"{tag} - last full pull was on {state['full']}, doing a full pull")
+            return None
+        if self.previous_file(tag) is None:
+            return None
+        return state['watermark']
+
+    def save_watermark(self,tag,watermark,full):
+        state = self.state(tag)
+        state['watermark'] = watermark
+        if full:
+            state['full'] = self.datetime.isoformat()
+        self.save_state(tag,state)
+
+    def previous_file(self,tag):
+        # == the data set stored by the last run, fetching it from the S3 backup if it is not here
+        base = self.lib.variables(tag,self.lib.config['STORE_FILE'])
+        if base == '':
+            return None
+        # -- the last run may have used another compression
+        for t in [ base + suffix for suffix,_ in COMPRESSION.values() ]:
+            if os.path.exists(t):
+                return t
+        target = self.lib.compressed(base)
+        if self.lib.config['STORE_AWS_S3_BUCKET'] != '':
+            os.makedirs(os.path.dirname(os.path.abspath(target)),exist_ok = True)
+            self.lib.download_from_s3(self.lib.config['STORE_AWS_S3_BUCKET'],self.lib.compressed(self.lib.variables(tag,self.lib.config['STORE_AWS_S3_BACKUP'])),target = 'file',parameter = target)
+        return target if os.path.exists(target) else None
+
+    def previous(self,tag):
+        target = self.previous_file(tag)
+        if target is None:
+            return
+        with self.lib.open_data(target,'rt') as q:
+            first = q.readline()
+            if first.strip() != '[':
+                # -- written before records were stored one per line
+                yield from json.loads(first + q.read())
+                return
+            for line in q:
+                line = line.strip().rstrip(',')
+                if line not in ('',']'):
+                    yield json.loads(line)
+
+    def merge(self,tag,data,key,drop):
+        # == new records replace the previous ones with the same key, the rest of the previous data set is kept.
+        # == Records matching drop are removed, whether they are new or were kept from the previous run.
+        seen = set()
+        for d in data:
+            seen.add(key(d))
+            if drop is None or not drop(d):
+                yield d
+        kept = 0
+        for d in self.previous(tag):
+            if key(d) not in seen and (drop is None or not drop(d)):
+                kept += 1
+                yield d
+        logging.info(f"{tag} - merged {len(seen)} new or changed records with {kept} previous records")
+
+    def store(self,tag,data1,key = None,drop = None):
+        # == data1 can be a list, or any iterator / generator of records.  We peek at the first record
+        # == so we can warn on an empty data set without materialising the rest of it.
+        # == With a key (a field name, or a function of the record), data1 only has to hold new or changed records,
+        # == and is merged into the data set stored by the last run.  Records matching drop are removed from it.
+        if key is not None:
+            if not callable(key):
+                field = key
+                key = lambda d: d.get(field)
+            data1 = self.merge(tag,data1,key,drop)
+        data = self.add_meta(data1)
+        first = next(data,None)
+        if first is None:
             logging.warning(f"No records to be written to {tag} - empty data set")
-    
-    def store_file(self,tag,data):
-        target = self.lib.variables(tag,self.lib.config['STORE_FILE'])
+            return 0
+
+        logging.info(f"Storing {tag}")
+        sinks = [s for s in [
+            FileSink(self,tag),
+            PostgresSink(self,tag),
+            DuckDBSink(self,tag),
+            ParquetSink(self,tag)
+        ] if s.ok]
+
+        # == each record is encoded exactly once, and the same bytes are handed to every sink
+        # == The content hash is the sum of the hashes of every record (so the order does not matter), and
+        # == leaves out the _upload_* fields add_meta put at the end of each record.
+        records = 0
+        size = 0
+        digest = 0
         try:
-            os.makedirs(os.path.dirname(target),exist_ok = True)        
-            with open(target,"wt",encoding='UTF-8') as q:
-                q.write(json.dumps(data,default=str))
-            logging.info(f"Saving {len(data)} records for {tag} --> {target}")
+            for d in itertools.chain([first],data):
+                line = json.dumps(d,default=str).encode('utf-8')
+                for s in sinks:
+                    s.write(line)
+                digest += int.from_bytes(hashlib.sha256(line.rsplit(b', "_upload_timestamp": ',1)[0]).digest(),'big')
+                records += 1
+                size += len(line)
         except:
-            logging.error(f"Cannot write the file - {target}")
+            # -- if the source fails half way, don't leave a partial data set behind
+            logging.error(f"Storing {tag} failed after {records} records - nothing will be written")
+            for s in sinks:
+                s.abort()
+            raise
 
-    def upload_to_s3(self,data,tag,target):
-        key = self.lib.variables(tag,target)
-        if key != '' and self.lib.config['STORE_AWS_S3_BUCKET'] != '':
-            logging.info(f"Saving {len(data)} records for {tag} --> s3://{self.lib.config['STORE_AWS_S3_BUCKET']}/{key}")
-            try:
-                boto3.resource('s3').Bucket(self.lib.config['STORE_AWS_S3_BUCKET']).put_object(
-                    ACL         = 'bucket-owner-full-control',
-                    ContentType = 'application/json',
-                    Key         = key,
-                    Body        = json.dumps(data,default=str)
-                )
-                logging.info(f"s3.put_object - s3://{self.check_env('STORE_AWS_S3_BUCKET')}/{target}")
-            except botocore.exceptions.ClientError as error:
-                logging.error(f"s3.put_object - {error.response['Error']['Code']}")
-            except:
-                logging.error(f"s3.put_object")
+        # == when nothing changed since the last run (and we still have its file), nothing is written at all
+        digest = f"{digest % 2**256:064x}"
+        state = self.state(tag)
+        target = self.lib.compressed(self.lib.variables(tag,self.lib.config['STORE_FILE']))
+        if self.check_env('STORE_SKIP_UNCHANGED','true').lower() == 'true' and state.get('hash') == digest and (target == '' or os.path.exists(target)):
+            for s in sinks:
+                s.abort()
+            state['unchanged'] = self.datetime.isoformat()
+            logging.info(f"Unchanged {tag} - {records} records, the same as on {state['changed']} - nothing will be written")
         else:
-            logging.warning(f"- Not uploading to S3...")
+            # -- the hash is only kept when every sink has the data, so a sink that failed is written again on the next run
+            failed = [ type(s).__name__ for s in sinks if not s.close(records) ]
+            state['changed'] = self.datetime.isoformat()
+            state.pop('unchanged',None)
+            if failed:
+                state.pop('hash',None)
+                logging.error(f"Stored {tag} - {records} records, but {', '.join(failed)} failed - it will be written again on the next run")
+            else:
+                state['hash'] = digest
+                logging.info(f"Stored {tag} - {records} records ({size} bytes)")
+        self.save_state(tag,state)
+
+        # -- keep a tally per plugin, so wrapper.py can report on it
+        with _stats_lock:
+            plugin = stats.setdefault(self.meta.get('plugin',self.meta['title']),{ 'records' : 0, 'bytes' : 0 })
+            plugin['records'] += records
+            plugin['bytes'] += size
+        return records
+
+class FileSink:
+    def __init__(self,C,tag):
+        self.C = C
+        self.tag = tag
+        self.base = C.lib.variables(tag,C.lib.config['STORE_FILE'])
+        self.target = C.lib.compressed(self.base)
+        self.ok = False
+        if self.target == '':
+            return
+        try:
+            os.makedirs(os.path.dirname(self.target),exist_ok = True)
+            self.q = C.lib.open_data(f"{self.target}.partial","wb",C.lib.config['STORE_COMPRESSION'])
+            self.q.write(b'[\n')
+            self.first = True
+            self.ok = True
+        except:
+            logging.error(f"Cannot write the file - {self.target}")
+
+    def write(self,line):
+        # -- one record per line, so the file stays a valid JSON array
+        if not self.first:
+            self.q.write(b',\n')
+        self.q.write(line)
+        self.first = False
+
+    def abort(self):
+        self.q.close()
+        os.remove(f"{self.target}.partial")
+
+    def close(self,records):
+        self.q.write(b'\n]')
+        self.q.close()
+        os.replace(f"{self.target}.partial",self.target)
+        # -- a copy left behind by a run with another compression would be read twice
+        for suffix,_ in COMPRESSION.values():
+            if self.base + suffix != self.target and os.path.exists(self.base + suffix):
+                os.remove(self.base + suffix)
+        logging.info(f"Saving {records} records for {self.tag} --> {self.target}")
+        return self.upload_to_s3()
+
+    def upload_to_s3(self):
+        # == the local file is streamed to S3 once.  The second key is a server side copy of the first.
+        # == Returns False when one of the configured uploads failed.
+        bucket = self.C.lib.config['STORE_AWS_S3_BUCKET']
+        backup = self.C.lib.compressed(self.C.lib.variables(self.tag,self.C.lib.config['STORE_AWS_S3_BACKUP']))
+        key = self.C.lib.compressed(self.C.lib.variables(self.tag,self.C.lib.config['STORE_AWS_S3_KEY']))
+
+        uploaded = self.C.lib.backup_to_s3(self.target,bucket,backup)
+        ok = uploaded or bucket == '' or backup == ''
+        if key != '' and bucket != '':
+            logging.info(f"Saving {self.tag} --> s3://{bucket}/{key}")
+            if uploaded:
+                ok = self.C.lib.copy_in_s3(bucket,backup,key) and ok
+            else:
+                ok = self.C.lib.upload_to_s3(self.target,bucket,key) == True and ok
+        else:
+            logging.warning("- Not uploading to S3...")
+        return ok
+
+class PostgresSink:
+    def __init__(self,C,tag):
+        self.C = C
+        self.tag = tag
+        self.ok = False
+        self.schema = C.check_env('STORE_POSTGRES_SCHEMA','public')
+        if not postgres_pool(C):
+            return
+
+        # -- rows are staged as CSV, and only sent (with a single COPY) when we close, once we know the data set changed
+        self.prefix = f'{C.upload_timestamp},"{C.lib.config["tenancy"].replace(chr(34),chr(34)*2)}","'.encode('utf-8')
+        self.buffer = tempfile.SpooledTemporaryFile(max_size = 64 * 1024 * 1024)
+        self.ok = True
+
+    def write(self,line):
+        self.buffer.write(self.prefix + line.replace(b'"',b'""') + b'"\n')
+
+    def abort(self):
+        self.buffer.close()
+
+    def close(self,records):
+        start = time.time()
+        pool = postgres_pool(self.C)
+        # -- getconn() raises instead of waiting when every connection is in use, so we wait for one here
+        _postgres_slots.acquire()
+        try:
+            con = pool.getconn()
+        except (Exception, Error) as error:
+            logging.error(f"Postgres - Unable to get a connection from the pool : {error}")
+            _postgres_slots.release()
+            self.buffer.close()
+            return False
 
-    def store_postgres(self,tag,data):
-        host        = self.check_env('STORE_POSTGRES_HOST')
-        user        = self.check_env('STORE_POSTGRES_USER')
-        password    = self.check_env('STORE_POSTGRES_PASSWORD')
-        dbname      = self.check_env('STORE_POSTGRES_DBNAME')
-        port        = self.check_env('STORE_POSTGRES_PORT')
-        schema      = self.check_env('STORE_POSTGRES_SCHEMA')
+        # -- the schema and table only need to be created once per process
+        if self.tag not in _postgres_tables:
+            cursor = con.cursor()
+            try:
+                cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {self.schema}")
+                con.commit()
+            except (Exception, Error) as error:
+                con.rollback()
+                logging.error(f"Postgres - Unable to create schema : {error}")
+
+            try:
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.schema}.{self.tag} (upload_timestamp timestamp, tenancy VARCHAR, json_data json)")
+                con.commit()
+                _postgres_tables.add(self.tag)
+            except (Exception, Error) as error:
+                con.rollback()
+                logging.error(f"Postgres - Unable to create table : {error}")
+            cursor.close()
+
+        self.buffer.seek(0)
+        try:
+            with con.cursor() as cursor:
+                cursor.copy_expert(f"COPY {self.schema}.{self.tag} (upload_timestamp,tenancy,json_data) FROM STDIN WITH (FORMAT csv)",self.buffer)
+            con.commit()
+            elapsed = time.time() - start
+            logging.info(f"Postgres - {self.tag} - Inserted {records} records in {elapsed:.1f}s ({records / max(elapsed,0.001):.0f} rows/sec).")
+            return True
+        except (Exception, Error) as error:
+            logging.error(f"Postgres - Unable to copy records : {error}")
+            con.rollback()
+            return False
+        finally:
+            self.buffer.close()
+            pool.putconn(con)
+            _postgres_slots.release()
 
-        if host:
+def postgres_pool(C):
+    # == a single connection pool per process, shared by every plugin launched by wrapper.py.  It holds up to
+    # == STORE_POSTGRES_POOL connections - more sinks than that closing at the same time wait for a connection.
+    global _postgres_pool, _postgres_slots
+    host = C.check_env('STORE_POSTGRES_HOST')
+    if not host:
+        return None
+    with _postgres_lock:
+        if _postgres_pool is None:
+            maxconn = int(C.check_env('STORE_POSTGRES_POOL','4'))
             try:
-            # Connect to your PostgreSQL database
-                con = psycopg2.connect(
-                    user        = user,
-                    password    = password,
+                _postgres_pool = psycopg2.pool.ThreadedConnectionPool(
+                    1,
+                    maxconn,
+                    user        = C.check_env('STORE_POSTGRES_USER'),
+                    password    = C.check_env('STORE_POSTGRES_PASSWORD'),
                     host        = host,
-                    port        = port,
-                    database    = dbname,
+                    port        = C.check_env('STORE_POSTGRES_PORT'),
+                    database    = C.check_env('STORE_POSTGRES_DBNAME'),
                 )
+                _postgres_slots = threading.BoundedSemaphore(maxconn)
+                logging.info(f"Postgres : Connected : {host}")
+                atexit.register(_postgres_pool.closeall)
             except (Exception, Error) as error:
-                self.con = False
-                logging.error(f"Postgres - Unable to connect : {host}")
-                return
+                logging.error(f"Postgres - Unable to connect : {host} - {error}")
+                return None
+    return _postgres_pool
 
-            if con:
-                logging.info(f"Postgres : Connected : {host}")
+_postgres_pool = None
+_postgres_slots = None
+_postgres_lock = threading.Lock()
+_postgres_tables = set()
 
-                try:
-                    cursor = con.cursor()
-                    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
-                    con.commit()
-                except (Exception, Error) as error:
-                    logging.error(f"Postgres - Unable to create schema : {error}")
+class StagedSink:
+    # == records are staged as newline delimited JSON next to the target, and loaded in one go when we close
+    def stage(self,target):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(target)),exist_ok = True)
+            self.q = tempfile.NamedTemporaryFile(dir = os.path.dirname(os.path.abspath(target)), prefix = f".{self.tag}.", suffix = '.json', delete = False)
+            return True
+        except:
+            logging.error(f"Unable to create the staging file for {self.tag} next to {target}")
+            return False
 
-                try:
-                    cursor.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{tag} (upload_timestamp timestamp, tenancy VARCHAR, json_data json)")
-                except (Exception, Error) as error:
-                    logging.error(f"Postgres - Unable to create table : {error}")
-                con.commit()
+    def write(self,line):
+        self.q.write(line + b'\n')
 
-                # -- insert data
-                for d in data:
-                    try:
-                        cursor.execute(f"INSERT INTO {schema}.{tag} (upload_timestamp,tenancy,json_data) VALUES(%s,%s,%s)",(self.upload_timestamp,self.lib.config['tenancy'],json.dumps(d)))
-                    except (Exception, Error) as error:
-                        logging.error(f"Postgres - Unable to insert record : {error}")
-                con.commit()
-                cursor.close()
-                logging.info(f"Postgres - {tag} - Inserted {len(data)} records.")
+    def abort(self):
+        self.q.close()
+        os.remove(self.q.name)
+
+class DuckDBSink(StagedSink):
+    def __init__(self,C,tag):
+        self.C = C
+        self.tag = tag
+        self.ok = False
+        self.target = C.lib.variables(tag,C.lib.config['STORE_DUCKDB'])
+        self.typed = C.check_env('STORE_DUCKDB_TYPED','false').lower() == 'true'
+        if self.target == '':
+            return
+        self.ok = self.stage(self.target)
 
-    def store_duckdb(self,tag,data):
-        target = self.lib.variables(tag,self.lib.config['STORE_DUCKDB'])
-        if target != '':
+    def close(self,records):
+        self.q.close()
+        start = time.time()
+        ok = False
+        # -- the connection is taken, used and released under the lock, so no other thread can use it once it is closed
+        with _duckdb_lock:
+            db = duckdb_connect(self.target)
+            if not db:
+                os.remove(self.q.name)
+                return False
+            cursor = db.cursor()
             try:
-                db = duckdb.connect(database = target, read_only = False)
-                logging.info(f"DuckDB : Connected : {target}")
-            except:
-                db = False
-                logging.error(f"DuckDB - Unable to connect : {target}")
-
-            if db:
-                # -- create table
-                cursor = db.cursor()
-                cursor.execute(f"CREATE TABLE IF NOT EXISTS {tag} (upload_timestamp timestamp, tenancy VARCHAR, json_data TEXT)")
-                db.commit()
-
-                # -- insert data
-                for d in data:
-                    cursor.execute(f"INSERT INTO {tag} (upload_timestamp,tenancy,json_data) VALUES(?,?,?)",(self.upload_timestamp,self.lib.config['tenancy'],json.dumps(d)))
-                db.commit()
+                if self.typed:
+                    # -- typed, unnested columns, inferred by DuckDB's JSON reader over the whole staged file
+                    source = f"read_json('{self.q.name}', format = 'newline_delimited', sample_size = -1)"
+                    if cursor.execute("SELECT count(*) FROM information_schema.tables WHERE table_name = ?",[self.tag]).fetchone()[0] == 0:
+                        cursor.execute(f"CREATE TABLE {self.tag} AS SELECT * FROM {source}")
+                    else:
+                        cursor.execute(f"INSERT INTO {self.tag} BY NAME SELECT * FROM {source}")
+                else:
+                    cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.tag} (upload_timestamp timestamp, tenancy VARCHAR, json_data TEXT)")
+                    cursor.execute(f"INSERT INTO {self.tag} (upload_timestamp,tenancy,json_data) SELECT ?, ?, json FROM read_json_objects('{self.q.name}', format = 'newline_delimited')",(self.C.upload_timestamp,self.C.lib.config['tenancy']))
+                elapsed = time.time() - start
+                logging.info(f"DuckDB - {self.tag} - Inserted {records} records in {elapsed:.1f}s.")
+                ok = True
+            except duckdb.Error as error:
+                logging.error(f"DuckDB - {self.tag} - Unable to load records : {error}")
+            finally:
                 cursor.close()
-                logging.info(f"DuckDB - {tag} - Inserted {len(data)} records.")
+                if release_duckdb and self.target in _duckdb:
+                    _duckdb.pop(self.target).close()
+        os.remove(self.q.name)
+        return ok
+
+class ParquetSink(StagedSink):
+    def __init__(self,C,tag):
+        self.C = C
+        self.tag = tag
+        self.ok = False
+        self.target = C.lib.variables(tag,C.lib.config['STORE_PARQUET'])
+        if self.target == '':
+            return
+        self.ok = self.stage(self.target)
+
+    def close(self,records):
+        self.q.close()
+        start = time.time()
+        source = f"read_json('{self.q.name}', format = 'newline_delimited', sample_size = -1)"
+        ok = False
+        try:
+            db = duckdb.connect()
+            # -- the schema is inferred once over the whole data set, with any known column types applied on top
+            overrides = self.C.lib.column_types.get(self.tag,{})
+            if overrides:
+                columns = { c[0] : c[1] for c in db.execute(f"DESCRIBE SELECT * FROM {source}").fetchall() }
+                columns.update(overrides)
+                # -- a struct literal of quoted column names and type strings, so a quote in either cannot break the SQL
+                columns = ', '.join(f"\"{c.replace(chr(34),chr(34)*2)}\" : '{t.replace(chr(39),chr(39)*2)}'" for c,t in columns.items())
+                source = f"read_json('{self.q.name}', format = 'newline_delimited', columns = {{ {columns} }})"
+            db.execute(f"COPY (SELECT * FROM {source}) TO '{self.target}.partial' (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE {self.C.check_env('STORE_PARQUET_ROW_GROUP','100000')})")
+            db.close()
+            os.replace(f"{self.target}.partial",self.target)
+            elapsed = time.time() - start
+            logging.info(f"Parquet - Saving {records} records for {self.tag} --> {self.target} in {elapsed:.1f}s")
+            ok = True
+        except duckdb.Error as error:
+            logging.error(f"Parquet - {self.tag} - Unable to write {self.target} : {error}")
+            if os.path.exists(f"{self.target}.partial"):
+                os.remove(f"{self.target}.partial")
+        os.remove(self.q.name)
+        return ok
+
+def duckdb_connect(target):
+    # == connections are kept open for the life of the process, and shared across tags.
+    # == Another process may hold the lock on the file, so we wait for it for a while.
+    with _duckdb_lock:
+        if target not in _duckdb:
+            wait = int(os.environ.get('STORE_DUCKDB_LOCK_TIMEOUT','300'))
+            start = time.time()
+            while True:
+                try:
+                    _duckdb[target] = duckdb.connect(database = target, read_only = False)
+                    logging.info(f"DuckDB : Connected : {target}")
+                    atexit.register(lambda: _duckdb[target].close() if target in _duckdb else None)
+                    break
+                except duckdb.IOException as error:
+                    if 'lock' in str(error).lower() and time.time() - start < wait:
+                        time.sleep(1)
+                        continue
+                    logging.error(f"DuckDB - Unable to connect : {target} - {error}")
+                    return None
+                except:
+                    logging.error(f"DuckDB - Unable to connect : {target}")
+                    return None
+        return _duckdb[target]
+
+_duckdb = {}
+# -- re-entrant, as DuckDBSink.close holds it while it calls duckdb_connect
+_duckdb_lock = threading.RLock()
+
+# == when several collector processes load into the same DuckDB file, each one only holds the lock while it loads
+release_duckdb = False
+
+# == records and bytes stored, per plugin
+stats = {}
+_stats_lock = threading.Lock()
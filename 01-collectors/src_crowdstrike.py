@@ -1,93 +1,156 @@
 from collector import Collector
+from http_client import backoff
 import os
 from falconpy import Hosts, SpotlightVulnerabilities, ZeroTrustAssessment
 import time
+import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import logging
 
 def hosts(C):
+    # == Returns the ids of the hosts (in chunks), and when each host was last seen
     logging.info("- hosts")
-    host_detail = []
     host_list = []
+    last_seen = {}
     falcon = Hosts(
         client_id=os.environ["FALCON_CLIENT_ID"],
         client_secret=os.environ["FALCON_SECRET"]
     )
-    OFFSET = 0
-    TOTAL = 1
-    LIMIT = 500
-    while OFFSET < TOTAL:
-        result = falcon.query_devices_by_filter(limit=LIMIT, offset=OFFSET)
-        OFFSET = 0
-        TOTAL = 0
-        returned_device_list = []
-        if result["status_code"] == 200:
-            OFFSET = result["body"]["meta"]["pagination"]["offset"]
-            TOTAL = result["body"]["meta"]["pagination"]["total"]
-            returned_device_list = result["body"]["resources"]
-
-            if returned_device_list:
-                host_list.append(returned_device_list)
-                host_detail += falcon.get_device_details(ids=returned_device_list)["body"]["resources"]
-        else:
+    LIMIT = 5000    # ids per scroll page
+    CHUNK = 500     # ids per detail lookup
+    THREADS = int(os.environ['FALCON_THREADS'])
+
+    def details(ids):
+        result = falcon.get_device_details(ids=ids)
+        if result["status_code"] != 200:
             logging.error(f"Something went wrong - {result['status_code']} - {result['body']['errors'][0]['message']}")
-            break
-    C.store('crowdstrike_hosts',host_detail)
-    return host_list
+            return []
+        return result["body"]["resources"]
+
+    def fetch():
+        # == the scroll query produces pages of ids, while a pool of threads looks up the details of the previous pages
+        start = time.time()
+        count = 0
+        with ThreadPoolExecutor(max_workers = THREADS) as pool:
+            pending = deque()
+            OFFSET = None
+            RETURNED = 0
+            TOTAL = 1
+            while RETURNED < TOTAL:
+                result = falcon.query_devices_by_filter_scroll(limit=LIMIT, offset=OFFSET)
+                if result["status_code"] != 200:
+                    logging.error(f"Something went wrong - {result['status_code']} - {result['body']['errors'][0]['message']}")
+                    break
+                OFFSET = result["body"]["meta"]["pagination"]["offset"]
+                TOTAL = result["body"]["meta"]["pagination"]["total"]
+                returned_device_list = result["body"]["resources"]
+                if not returned_device_list:
+                    break
+                RETURNED += len(returned_device_list)
+                logging.info(f"returned = {RETURNED} / {TOTAL}")
+
+                for i in range(0,len(returned_device_list),CHUNK):
+                    host_list.append(returned_device_list[i:i+CHUNK])
+                    pending.append(pool.submit(details,returned_device_list[i:i+CHUNK]))
+
+                # -- hand over whatever is ready, and don't let the lookups fall too far behind the scroll
+                while pending and (pending[0].done() or len(pending) > THREADS * 2):
+                    for h in pending.popleft().result():
+                        count += 1
+                        last_seen[h.get('device_id')] = h.get('last_seen')
+                        yield h
 
-def vulnerabilities(C):
+            while pending:
+                for h in pending.popleft().result():
+                    count += 1
+                    last_seen[h.get('device_id')] = h.get('last_seen')
+                    yield h
+        elapsed = time.time() - start
+        logging.info(f"Retrieved {count} hosts in {elapsed:.1f}s ({count / max(elapsed,0.001):.0f} hosts/sec)")
+
+    C.store('crowdstrike_hosts',fetch())
+    return host_list, last_seen
+
+def vulnerabilities(C,last_seen):
     logging.info("- vulnerabilities")
+    tag = 'crowdstrike_vulnerabilities'
     #query_filter = "cve.id:!['']+status:!'closed'+status:!'expired'+last_seen_within:'14'"
     #query_filter = "cve.id:!['']+cve.exprt_rating:['HIGH','CRITICAL']+status:!'closed'+status:!'expired'+last_seen_within:'14'"
     #query_filter = "cve.id:!['']+cve.exprt_rating:['HIGH','CRITICAL']+last_seen_within:'14'"
-    query_filter = "cve.id:!['']+last_seen_within:'14'"
-    spotlight = SpotlightVulnerabilities(
-        client_id=os.environ["FALCON_CLIENT_ID"],
-        client_secret=os.environ["FALCON_SECRET"]
-    )
-    TOTAL = 1
-    AFTER = None
-    RETURNED = 0
-    returned_vulnerabilities = []
-    while RETURNED < TOTAL:
-        if spotlight.token_expired():
-            logging.warning("Token expired...")
-            spotlight = SpotlightVulnerabilities(
-                client_id=os.environ["FALCON_CLIENT_ID"],
-                client_secret=os.environ["FALCON_SECRET"]
-            )
-            
-        logging.info(f"returned = {RETURNED} / {TOTAL}")
-        result = spotlight.query_vulnerabilities_combined(
-            filter=query_filter,
-            after=AFTER,
-            sort="updated_timestamp|asc",
-            limit=400,
-            facet={"cve", "host_info", "remediation"} #, "evaluation_logic"
+    window = 14
+    query_filter = f"cve.id:!['']+last_seen_within:'{window}'"
+
+    # == only fetch what changed since the last run, and merge it into the stored data set
+    watermark = C.watermark(tag,int(os.environ['FALCON_FULL_REFRESH_DAYS']))
+    if watermark:
+        logging.info(f"Incremental pull - updated since {watermark}")
+        query_filter += f"+updated_timestamp:>='{watermark}'"
+    latest = { 'updated_timestamp' : watermark }
+
+    def fetch():
+        spotlight = SpotlightVulnerabilities(
+            client_id=os.environ["FALCON_CLIENT_ID"],
+            client_secret=os.environ["FALCON_SECRET"]
         )
-        # == handle a rate limit
-        while result["status_code"] == 429:
-            print("Rate limit met, waiting 0.5 seconds to retry.")
-            time.sleep(0.5)
+        TOTAL = 1
+        AFTER = None
+        RETURNED = 0
+        while RETURNED < TOTAL:
+            if spotlight.token_expired():
+                logging.warning("Token expired...")
+                spotlight = SpotlightVulnerabilities(
+                    client_id=os.environ["FALCON_CLIENT_ID"],
+                    client_secret=os.environ["FALCON_SECRET"]
+                )
+                
+            logging.info(f"returned = {RETURNED} / {TOTAL}")
             result = spotlight.query_vulnerabilities_combined(
                 filter=query_filter,
                 after=AFTER,
-                #sort="updated_timestamp|asc",
+                sort="updated_timestamp|asc",
                 limit=400,
                 facet={"cve", "host_info", "remediation"} #, "evaluation_logic"
             )
+            # == handle a rate limit - CrowdStrike tells us (as an epoch time) when the limit resets
+            attempt = 0
+            while result["status_code"] == 429 and attempt < 5:
+                reset = result.get("headers",{}).get("X-Ratelimit-Retryafter")
+                wait = backoff(attempt,int(reset) - time.time() if reset else None)
+                logging.warning(f"Rate limit met, waiting {wait:.1f} seconds to retry.")
+                time.sleep(wait)
+                attempt += 1
+                result = spotlight.query_vulnerabilities_combined(
+                    filter=query_filter,
+                    after=AFTER,
+                    sort="updated_timestamp|asc",
+                    limit=400,
+                    facet={"cve", "host_info", "remediation"} #, "evaluation_logic"
+                )
 
-        # == successful
-        if result["status_code"] == 200:
-            AFTER = result["body"]["meta"]["pagination"]["after"]
-            TOTAL = result["body"]["meta"]["pagination"]["total"]
-            returned_vulnerabilities += result["body"]["resources"]
-            RETURNED = len(returned_vulnerabilities)
+            # == successful
+            if result["status_code"] == 200:
+                AFTER = result["body"]["meta"]["pagination"]["after"]
+                TOTAL = result["body"]["meta"]["pagination"]["total"]
+                RETURNED += len(result["body"]["resources"])
+                for v in result["body"]["resources"]:
+                    if v.get('updated_timestamp') and (latest['updated_timestamp'] is None or v['updated_timestamp'] > latest['updated_timestamp']):
+                        latest['updated_timestamp'] = v['updated_timestamp']
+                    yield v
+                if not result["body"]["resources"]:
+                    break
+            else:
+                logging.error(f"Something went wrong - {result['status_code']} - {result['body']['errors'][0]['message']}")
+                break
 
-        else:
-            logging.error(f"Something went wrong - {result['status_code']} - {result['body']['errors'][0]['message']}")
-            break
-    C.store('crowdstrike_vulnerabilities',returned_vulnerabilities)
+    # -- the merged data set keeps the same window as a full pull (last_seen_within), so the findings of hosts that were
+    # -- not seen within it are aged out.  The host is looked up in the inventory we just pulled, as the finding itself
+    # -- only carries when its host was last seen at the time it was last updated.
+    cutoff = (C.datetime - datetime.timedelta(days = window)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    drop = lambda d: (last_seen.get(d.get('aid')) or d.get('host_last_seen_timestamp') or '') < cutoff
+    C.store(tag,fetch(),key = 'id' if watermark else None,drop = drop)
+    C.save_watermark(tag,latest['updated_timestamp'],watermark is None)
 
 def zero_trust_assessment(C,host_list):
     logging.info("- zero_trust_assessment")
@@ -108,16 +171,18 @@ def meta():
         'functions' : [ 'hosts', 'vulnerabilities','zero_trust_assessment'],
         'env' : {
             'FALCON_CLIENT_ID' : None,
-            'FALCON_SECRET'    : None
+            'FALCON_SECRET'    : None,
+            'FALCON_THREADS'   : '8',
+            'FALCON_FULL_REFRESH_DAYS' : '7'
         }
     }
 
 def main():
     C = Collector(meta())
     if C.test_environment():
-        host_list = hosts(C)
+        host_list, last_seen = hosts(C)
         zero_trust_assessment(C,host_list)
-        vulnerabilities(C)
+        vulnerabilities(C,last_seen)
 
 if __name__ == '__main__':
     load_dotenv()
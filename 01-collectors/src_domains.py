@@ -1,45 +1,139 @@
 from collector import Collector
+from http_client import Histogram, backoff
 from dotenv import load_dotenv
 import os
+import json
+import time
+import datetime
+import asyncio
+import aiohttp
 import whois
-import dns.resolver
-import requests
+import dns.asyncresolver
 import logging
 
-def get_server_headers(url):
-    try:
-        response = requests.get(url, timeout=10)
-        headers_dict = dict(response.headers)
-        return headers_dict
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return {}
+def new_stats():
+    stats = { t : { 'ok' : 0, 'errors' : 0, 'cached' : 0 } for t in ['whois','dns','http'] }
+    stats['latency'] = Histogram()
+    return stats
+
+async def get_server_headers(session,url,stats):
+    for attempt in range(3):
+        start = time.monotonic()
+        try:
+            async with session.get(url) as response:
+                stats['latency'].observe(time.monotonic() - start)
+                if response.status in [429, 503] and attempt < 2:
+                    await asyncio.sleep(backoff(attempt,response.headers.get('Retry-After'),cap = 10))
+                    continue
+                # -- repeated headers are folded into one value, the same way requests does it
+                headers_dict = {}
+                for k,v in response.headers.items():
+                    headers_dict[k] = f"{headers_dict[k]}, {v}" if k in headers_dict else v
+                stats['http']['ok'] += 1
+                return headers_dict
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            stats['latency'].observe(time.monotonic() - start)
+            logging.warning(f"{url} - An error occurred: {e!r}")
+            stats['http']['errors'] += 1
+            return {}
 
-def get_domain_info(domain,type):
+async def get_domain_info(resolver,domain,type,stats):
     try:
-        return list(dns.resolver.resolve(domain, type))
-    except:
+        answer = list(await resolver.resolve(domain, type))
+        stats['dns']['ok'] += 1
+        return answer
+    except Exception:
+        stats['dns']['errors'] += 1
         return []
-    
+
+async def get_whois(domain,cache,ttl,limit,stats):
+    # == whois data rarely changes, so we keep it for a few days.  The lookup itself is blocking, so it runs in a thread.
+    c = cache.get(domain)
+    if c and datetime.datetime.fromisoformat(c['fetched']) > datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days = ttl):
+        stats['whois']['cached'] += 1
+        return c
+    async with limit:
+        try:
+            w = await asyncio.to_thread(whois.whois,domain)
+        except Exception as e:
+            logging.warning(f"{domain} - whois failed : {e}")
+            stats['whois']['errors'] += 1
+            return {}
+    stats['whois']['ok'] += 1
+    cache[domain] = json.loads(json.dumps({
+        'fetched'           : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'expiration_date'   : w.expiration_date,
+        'updated_date'      : w.updated_date,
+        'creation_date'     : w.creation_date,
+        'name_servers'      : w.name_servers
+    },default=str))
+    return cache[domain]
+
+async def domain(session,resolver,limit,name,cache,ttl,whois_limit,stats):
+    async with limit:
+        w, txt, mx, http, https = await asyncio.gather(
+            get_whois(name,cache,ttl,whois_limit,stats),
+            get_domain_info(resolver,name,"TXT",stats),
+            get_domain_info(resolver,name,"MX",stats),
+            get_server_headers(session,f"http://{name}",stats),
+            get_server_headers(session,f"https://{name}",stats)
+        )
+    return {
+        'domain'            : name,
+        'expiration_date'   : w.get('expiration_date'),
+        'updated_date'      : w.get('updated_date'),
+        'creation_date'     : w.get('creation_date'),
+        'name_servers'      : w.get('name_servers'),
+        'txt'               : txt,
+        'mx'                : mx,
+        'headers'           :
+            {
+                'http'  : http,
+                'https' : https,
+            }
+    }
+
+async def collect(names,stats):
+    cache_file = os.environ['DOMAINS_WHOIS_CACHE']
+    cache = {}
+    if cache_file != '' and os.path.exists(cache_file):
+        with open(cache_file,'rt',encoding='UTF-8') as q:
+            cache = json.load(q)
+
+    resolver = dns.asyncresolver.Resolver()
+    resolver.lifetime = 10
+    if os.environ.get('DOMAINS_NAMESERVERS','') != '':
+        # -- ip or ip:port, separated by ;
+        ns = [ n.split(':') for n in os.environ['DOMAINS_NAMESERVERS'].split(';') ]
+        resolver.nameservers = [ n[0] for n in ns ]
+        if len(ns[0]) > 1:
+            resolver.port = int(ns[0][1])
+
+    limit = asyncio.Semaphore(int(os.environ['DOMAINS_CONCURRENCY']))
+    whois_limit = asyncio.Semaphore(int(os.environ['DOMAINS_WHOIS_CONCURRENCY']))
+    connector = aiohttp.TCPConnector(limit = 100, limit_per_host = 2)
+    async with aiohttp.ClientSession(connector = connector, timeout = aiohttp.ClientTimeout(total = 10)) as session:
+        data = await asyncio.gather(*[ domain(session,resolver,limit,n,cache,int(os.environ['DOMAINS_WHOIS_TTL']),whois_limit,stats) for n in names ])
+
+    if cache_file != '':
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)),exist_ok = True)
+        with open(cache_file,'wt',encoding='UTF-8') as q:
+            json.dump(cache,q)
+    return data
+
 def domains(C):
-    data = []
     logging.info("- domains")
-    for domain in os.environ["DOMAINS"].split(';'):
-        w = whois.whois(domain)
-        data.append({
-            'domain'            : domain,
-            'expiration_date'   : w.expiration_date,
-            'updated_date'      : w.updated_date,
-            'creation_date'     : w.creation_date,
-            'name_servers'      : w.name_servers,
-            'txt'               : get_domain_info(domain, "TXT"),
-            'mx'                : get_domain_info(domain, "MX"),
-            'headers'           : 
-                {
-                    'http'  : get_server_headers(f"http://{domain}"),
-                    'https' : get_server_headers(f"https://{domain}"),
-                }
-        })
+    names = [ d for d in os.environ["DOMAINS"].split(';') if d != '' ]
+    stats = new_stats()
+    start = time.time()
+    data = asyncio.run(collect(names,stats))
+    elapsed = time.time() - start
+
+    logging.info(f"Checked {len(names)} domains in {elapsed:.1f}s ({len(names) / max(elapsed,0.001):.1f} domains/sec)")
+    for t in ['whois','dns','http']:
+        total = stats[t]['ok'] + stats[t]['errors']
+        logging.info(f"- {t:5} : {stats[t]['ok']} ok, {stats[t]['errors']} errors ({stats[t]['errors'] / max(total,1) * 100:.1f}%), {stats[t]['cached']} cached")
+    logging.info(f"- http  : {stats['latency'].summary()}")
 
     C.store('domains',data)
 
@@ -50,7 +144,11 @@ def meta():
         'link'  : 'https://',
         'functions' : [ 'domains'],
         'env' : {
-            'DOMAINS' : None
+            'DOMAINS'                   : None,
+            'DOMAINS_CONCURRENCY'       : '50',
+            'DOMAINS_WHOIS_CONCURRENCY' : '4',
+            'DOMAINS_WHOIS_TTL'         : '7',
+            'DOMAINS_WHOIS_CACHE'       : '../data/cache/whois.json'
         }
     }
 
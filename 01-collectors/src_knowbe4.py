@@ -1,67 +1,38 @@
 import requests
 from collector import Collector
+from http_client import HttpClient
 from dotenv import load_dotenv
 import os
-import time
 import logging
 
 def enrollments(C):
     logging.info("- enrollments")
-    headers = {
+    # -- KnowBe4 allows 4 requests a second; retries and Retry-After are handled by the client
+    H = HttpClient(rate = float(os.environ['KNOWBE4_RATE']), headers = {
         "Authorization": f"Bearer {os.environ['KNOWBE4_TOKEN']}",
         "Accept": "application/json",
-    }
-    result = []
-    page = 1
-    max_retries = 5
-    backoff_factor = 1  # Base seconds for backoff
+    })
 
-    while True:
-        retry_count = 0
-        while retry_count < max_retries:
+    def fetch():
+        page = 1
+        while True:
+            logging.info(f"Fetching page {page}")
             try:
-                logging.info(f"Fetching page {page}")
-                req = requests.get(
-                    f"{os.environ['KNOWBE4_ENDPOINT']}?page={page}",
-                    headers=headers,
-                    timeout=30
-                )
-                req.raise_for_status()
-                
-                # Check if we hit rate limit (429)
-                if req.status_code == 429:
-                    retry_after = int(req.headers.get("Retry-After", backoff_factor))
-                    logging.warning(f"Rate limit hit. Retrying after {retry_after} seconds...")
-                    time.sleep(retry_after)
-                    retry_count += 1
-                    backoff_factor *= 2  # Exponential backoff
-                    continue
-
-                # Break out of retry loop on success
-                break
-            except requests.exceptions.HTTPError as err:
-                if req.status_code != 429:
-                    logging.error(f"HTTP error: {err}")
-                    break
+                req = H.get(f"{os.environ['KNOWBE4_ENDPOINT']}?page={page}")
             except requests.exceptions.RequestException as e:
                 logging.error(f"Request failed: {e}")
                 break
-            time.sleep(backoff_factor)
-
-        if req.status_code == 429 and retry_count >= max_retries:
-            logging.error("Max retries reached. Exiting.")
-            break
-
-        if req.status_code != 200:
-            break
-        
-        result += req.json()
-        page += 1
-
-        if not req.json():
-            break
+            if req.status_code != 200:
+                logging.error(f"HTTP error: {req.status_code} - {req.text}")
+                break
+            data = req.json()
+            if not data:
+                break
+            yield from data
+            page += 1
+        H.report()
 
-    C.store('knowbe4_enrollments', result)
+    C.store('knowbe4_enrollments', fetch())
 
 def meta():
     return {
@@ -71,7 +42,8 @@ def meta():
         'functions' : [ 'enrollments'],
         'env' : {
             'KNOWBE4_TOKEN'     : None,
-            'KNOWBE4_ENDPOINT'  : 'https://us.api.knowbe4.com/v1/training/enrollments'
+            'KNOWBE4_ENDPOINT'  : 'https://us.api.knowbe4.com/v1/training/enrollments',
+            'KNOWBE4_RATE'      : '4'
         }
     }
 
@@ -1,7 +1,9 @@
 from collector import Collector
+from http_client import HttpClient
 from dotenv import load_dotenv
-import asyncio
-from okta.client import Client as OktaClient
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 import logging
 
@@ -9,79 +11,147 @@ def meta():
     return {
         'plugin' : 'okta',
         'title'  : 'Okta',
-        'link'  : 'https://github.com/okta/okta-sdk-python',
-        'functions' : [ 'users'],
+        'link'  : 'https://developer.okta.com/docs/api/',
+        'functions' : [ 'users','groups','factors'],
         'env' : {
-            'OKTA_DOMAIN' : None,
-            'OKTA_TOKEN' : None
+            'OKTA_DOMAIN'   : None,
+            'OKTA_TOKEN'    : None,
+            'OKTA_RATE'     : '10',
+            'OKTA_THREADS'  : '8',
+            'OKTA_FACTORS'  : 'false'
         }
     }
 
-async def users(client,C):
-    data = []
-    users, resp, err = await client.list_users()
-    if err:
-        logging.error(err)
-        return False
-    
-    while True:
-        for user in users:
-            data.append({
-                'id'               : user.id,
-                'status'           : user.status,
-                'created'          : user.created,
-                'activated'        : user.activated,
-                'status_changed'   : user.status_changed,
-                'last_login'       : user.last_login,
-                'last_updated'     : user.last_updated,
-                'password_changed' : user.password_changed,
-                'type' : {
-                    'id' : user.type.id
-                },
+# == the fields we keep, and the name they are stored under (the same names the okta sdk used)
+USER = {
+    'id'                : 'id',
+    'status'            : 'status',
+    'created'           : 'created',
+    'activated'         : 'activated',
+    'status_changed'    : 'statusChanged',
+    'last_login'        : 'lastLogin',
+    'last_updated'      : 'lastUpdated',
+    'password_changed'  : 'passwordChanged'
+}
+PROFILE = {
+    'login'                 : 'login',
+    'first_name'            : 'firstName',
+    'last_name'             : 'lastName',
+    'nick_name'             : 'nickName',
+    'display_name'          : 'displayName',
+    'email'                 : 'email',
+    'secondEmail'           : 'secondEmail',
+    'profile_url'           : 'profileUrl',
+    'preferred_language'    : 'preferredLanguage',
+    'user_type'             : 'userType',
+    'organization'          : 'organization',
+    'title'                 : 'title',
+    'division'              : 'division',
+    'department'            : 'department',
+    'cost_center'           : 'costCenter',
+    'employee_number'       : 'employeeNumber',
+    'mobile_phone'          : 'mobilePhone',
+    'primary_phone'         : 'primaryPhone',
+    'street_address'        : 'streetAddress',
+    'city'                  : 'city',
+    'state'                 : 'state',
+    'zip_code'              : 'zipCode',
+    'country_code'          : 'countryCode'
+}
+
+def pages(H,url):
+    # == the raw json api, following the Link rel="next" header until there are no more pages
+    while url:
+        req = H.get(url)
+        if req.status_code != 200:
+            raise Exception(f"Okta returned {req.status_code} for {url} - {req.text}")
+        yield from req.json()
+        url = req.links.get('next',{}).get('url')
+
+def users(C,H,ids = None):
+    logging.info("- users")
+    def fetch():
+        for u in pages(H,f"{os.environ['OKTA_DOMAIN']}/api/v1/users?limit=200"):
+            if ids:
+                ids.put(u['id'])
+            p = u.get('profile') or {}
+            yield {
+                **{ k : u.get(v) for k,v in USER.items() },
+                'type'    : { 'id' : (u.get('type') or {}).get('id') },
+                'profile' : { k : p.get(v) for k,v in PROFILE.items() }
+            }
+    # -- factors() waits for the None, so it is sent however the store ends - even when it fails before fetch() starts
+    try:
+        C.store('okta_users',fetch())
+    finally:
+        if ids:
+            ids.put(None)
+
+def groups(C,H):
+    logging.info("- groups")
+    def fetch():
+        for g in pages(H,f"{os.environ['OKTA_DOMAIN']}/api/v1/groups?limit=10000"):
+            yield {
+                'id'                        : g.get('id'),
+                'type'                      : g.get('type'),
+                'created'                   : g.get('created'),
+                'last_updated'              : g.get('lastUpdated'),
+                'last_membership_updated'   : g.get('lastMembershipUpdated'),
                 'profile' : {
-                    'login'                 : user.profile.login,
-                    'first_name'            : user.profile.first_name,
-                    'last_name'             : user.profile.last_name,
-                    'nick_name'             : user.profile.nick_name,
-                    'display_name'          : user.profile.display_name,
-                    'email'                 : user.profile.email,
-                    'secondEmail'           : user.profile.secondEmail,
-                    'profile_url'           : user.profile.profile_url,
-                    'preferred_language'    : user.profile.preferred_language,
-                    'user_type'             : user.profile.user_type,
-                    'organization'          : user.profile.organization,
-                    'title'                 : user.profile.title,
-                    'division'              : user.profile.division,
-                    'department'            : user.profile.department,
-                    'cost_center'           : user.profile.cost_center,
-                    'employee_number'       : user.profile.employee_number,
-                    'mobile_phone'          : user.profile.mobile_phone,
-                    'primary_phone'         : user.profile.primary_phone,
-                    'street_address'        : user.profile.street_address,
-                    'city'                  : user.profile.city,
-                    'state'                 : user.profile.state,
-                    'zip_code'              : user.profile.zip_code,
-                    'country_code'          : user.profile.country_code,
+                    'name'          : (g.get('profile') or {}).get('name'),
+                    'description'   : (g.get('profile') or {}).get('description')
                 }
-            })
-        if resp.has_next():
-            users, err = await resp.next()
-        else:
-            break
-    C.store('okta_users',data)
+            }
+    C.store('okta_groups',fetch())
+
+def factors(C,H,ids):
+    logging.info("- factors")
+    def user_factors(uid):
+        try:
+            return [ {
+                'user_id'       : uid,
+                'id'            : f.get('id'),
+                'factor_type'   : f.get('factorType'),
+                'provider'      : f.get('provider'),
+                'vendor_name'   : f.get('vendorName'),
+                'status'        : f.get('status'),
+                'created'       : f.get('created'),
+                'last_updated'  : f.get('lastUpdated')
+            } for f in pages(H,f"{os.environ['OKTA_DOMAIN']}/api/v1/users/{uid}/factors") ]
+        except Exception as e:
+            logging.warning(f"{uid} - {e}")
+            return []
+
+    def fetch():
+        # == the user ids arrive on the queue while users() is still paging, ending with None
+        with ThreadPoolExecutor(max_workers = int(os.environ['OKTA_THREADS'])) as pool:
+            pending = deque()
+            while (uid := ids.get()) is not None:
+                pending.append(pool.submit(user_factors,uid))
+                while pending and pending[0].done():
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+    C.store('okta_factors',fetch())
 
 def main():
     C = Collector(meta())
     if C.test_environment():
-        client = OktaClient({
-            'orgUrl' : os.environ['OKTA_DOMAIN'],
-            'token'  : os.environ['OKTA_TOKEN']
+        H = HttpClient(rate = float(os.environ['OKTA_RATE']), pool = int(os.environ['OKTA_THREADS']) + 2, headers = {
+            'Authorization' : f"SSWS {os.environ['OKTA_TOKEN']}",
+            'Accept'        : 'application/json'
         })
 
-        # == users
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(users(client,C))
+        # -- factors need a call per user, so they are only collected when asked for
+        ids = queue.Queue() if os.environ['OKTA_FACTORS'].lower() == 'true' else None
+        with ThreadPoolExecutor(max_workers = 3) as pool:
+            jobs = [ pool.submit(users,C,H,ids), pool.submit(groups,C,H) ]
+            if ids:
+                jobs.append(pool.submit(factors,C,H,ids))
+        for j in jobs:
+            j.result()
+        H.report()
 
 if __name__ == '__main__':
     load_dotenv()
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,7 @@
 from collector import Collector
 from dotenv import load_dotenv
-import requests
+from http_client import HttpClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import logging
 
@@ -12,19 +13,24 @@ def meta():
         'functions' : [ 'organizations','members','projects','issues'],
         'env' : {
             'SNYK_TOKEN' : None,
-            'SNYK_ENDPOINT' : 'https://api.snyk.io'
+            'SNYK_ENDPOINT' : 'https://api.snyk.io',
+            'SNYK_THREADS'  : '8',
+            'SNYK_RATE'     : '25'
         }
     }
 
-def call(C,url):
-    logging.info(f"Calling ({url})")
-    data = []
-    headers = {
+def session():
+    # == one pooled client for every call, sized to the number of threads and kept under the Snyk rate limit
+    return HttpClient(rate = float(os.environ['SNYK_RATE']), pool = int(os.environ['SNYK_THREADS']), headers = {
         'Authorization' : os.environ['SNYK_TOKEN'],
         'Content-Type' : 'application/json; charset=utf-8',
-    }
+    })
+
+def call(S,url):
+    logging.info(f"Calling ({url})")
+    data = []
     while True:
-        req = requests.get(f"{os.environ['SNYK_ENDPOINT']}{url}",headers=headers,timeout=30)
+        req = S.get(f"{os.environ['SNYK_ENDPOINT']}{url}",timeout=30)
         if req.status_code != 200:
             print("==============================")
             print(f"something went wrong - {req.status_code}")
@@ -33,51 +39,52 @@ def call(C,url):
             print("==============================")
             break
         else:
-            if not 'data' in req.json():
-                data += req.json()
+            body = req.json()
+            if not 'data' in body:
+                data += body
                 break
             else:
-                data += req.json()['data']
+                data += body['data']
                 
-                if 'next' in req.json()['links']:
-                    url = req.json()['links']['next']
+                if 'next' in body['links']:
+                    url = body['links']['next']
                 else:
                     break
     return data
 
-def organizations(C):
-    data = call(C,'/rest/orgs?version=2024-08-25&limit=100')
+def per_org(S,pool,org,url):
+    # == every org is fetched on the pool, and handed over as soon as it is complete
+    jobs = [ pool.submit(call,S,url.replace('%ORG',o['id'])) for o in org ]
+    for j in as_completed(jobs):
+        yield from j.result()
+
+def organizations(C,S):
+    data = call(S,'/rest/orgs?version=2024-08-25&limit=100')
     C.store('snyk_organizations',data)
     return data
 
-def members(C,org):
-    data = []
-    for o in org:
-        data += call(C,f"/v1/org/{o['id']}/members?includeGroupAdmins=true")
-    C.store('snyk_members',data)
-    return data
+def members(C,S,pool,org):
+    C.store('snyk_members',per_org(S,pool,org,"/v1/org/%ORG/members?includeGroupAdmins=true"))
 
-def issues(C,org):
-    data = []
-    for o in org:
-        data += call(C,f"/rest/orgs/{o['id']}/issues?version=2024-08-25&limit=100")
-    C.store('snyk_issues',data)
-    return data
+def issues(C,S,pool,org):
+    C.store('snyk_issues',per_org(S,pool,org,"/rest/orgs/%ORG/issues?version=2024-08-25&limit=100"))
     
-def projects(C,org):
-    data = []
-    for o in org:
-        data += call(C,f"/rest/orgs/{o['id']}/projects?version=2024-08-25&limit=100")
-    C.store('snyk_projects',data)
-    return data
+def projects(C,S,pool,org):
+    C.store('snyk_projects',per_org(S,pool,org,"/rest/orgs/%ORG/projects?version=2024-08-25&limit=100"))
 
 def main():
     C = Collector(meta())
     if C.test_environment():
-        org = organizations(C)
-        members(C,org)
-        projects(C,org)
-        issues(C,org)
+        S = session()
+        org = organizations(C,S)
+
+        # -- all three endpoints are walked at the same time, sharing one pool of workers across every org
+        with ThreadPoolExecutor(max_workers = int(os.environ['SNYK_THREADS'])) as pool:
+            with ThreadPoolExecutor(max_workers = 3) as stores:
+                jobs = [ stores.submit(f,C,S,pool,org) for f in [members,projects,issues] ]
+        for j in jobs:
+            j.result()
+        S.report()
 
 if __name__ == '__main__':
     load_dotenv()
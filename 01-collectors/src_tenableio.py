@@ -2,46 +2,48 @@ from collector import Collector
 from dotenv import load_dotenv
 from tenable.io import TenableIO
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def findings(C):
-    tio = TenableIO(
+def connect():
+    return TenableIO(
         access_key=os.environ['TIO_ACCESS_KEY'],
         secret_key=os.environ['TIO_SECRET_KEY']
     )
-    data = []
-    for d in tio.exports.compliance():
-        data.append(d)   
-    C.store('tenable_findings',data)
+
+# == the export iterators are handed straight to C.store, so each chunk is written out as it arrives
+
+def findings(C):
+    C.store('tenable_findings',connect().exports.compliance())
 
 def assets(C):
-    tio = TenableIO(
-        access_key=os.environ['TIO_ACCESS_KEY'],
-        secret_key=os.environ['TIO_SECRET_KEY']
-    )
-    data = []
-    for d in tio.exports.assets():
-        data.append(d)   
-    C.store('tenable_assets',data)
+    # == after the first full export, only fetch the assets updated since the last run
+    tag = 'tenable_assets'
+    start = int(time.time())
+    watermark = C.watermark(tag,int(os.environ['TIO_FULL_REFRESH_DAYS']))
+    if watermark:
+        C.store(tag,connect().exports.assets(updated_at = int(watermark)),key = 'id',drop = lambda d: d.get('deleted_at') is not None)
+    else:
+        C.store(tag,connect().exports.assets())
+    C.save_watermark(tag,start,watermark is None)
 
 def was(C):
-    tio = TenableIO(
-        access_key=os.environ['TIO_ACCESS_KEY'],
-        secret_key=os.environ['TIO_SECRET_KEY']
-    )
-    data = []
-    for d in tio.was.export():
-        data.append(d)
-    C.store('tenable_was',data)
+    C.store('tenable_was',connect().was.export())
+
+def vulnerability_key(d):
+    return (d['asset']['uuid'],d['plugin']['id'],d.get('port',{}).get('port'),d.get('port',{}).get('protocol'))
 
 def vulnerabilities(C):
-    tio = TenableIO(
-        access_key=os.environ['TIO_ACCESS_KEY'],
-        secret_key=os.environ['TIO_SECRET_KEY']
-    )
-    data = []
-    for d in tio.exports.vulns():
-        data.append(d)
-    C.store('tenable_vulnerabilities',data)
+    # == after the first full export, only fetch the findings that changed since the last run.  Fixed findings
+    # == are requested too, so they can be removed from the stored data set.
+    tag = 'tenable_vulnerabilities'
+    start = int(time.time())
+    watermark = C.watermark(tag,int(os.environ['TIO_FULL_REFRESH_DAYS']))
+    if watermark:
+        C.store(tag,connect().exports.vulns(since = int(watermark),state = ['OPEN','REOPENED','FIXED']),key = vulnerability_key,drop = lambda d: d.get('state') == 'FIXED')
+    else:
+        C.store(tag,connect().exports.vulns())
+    C.save_watermark(tag,start,watermark is None)
 
 def meta():
     return {
@@ -51,17 +53,19 @@ def meta():
         'functions' : [ 'findings','assets','was','vulnerabilities'],
         'env' : {
             'TIO_ACCESS_KEY' : None,
-            'TIO_SECRET_KEY' : None
+            'TIO_SECRET_KEY' : None,
+            'TIO_FULL_REFRESH_DAYS' : '7'
         }
     }
 
 def main():
     C = Collector(meta())
     if C.test_environment():
-        findings(C)
-        assets(C)
-        was(C)
-        vulnerabilities(C)
+        # == Tenable prepares the exports server side, so we request all of them at the same time
+        with ThreadPoolExecutor(max_workers = 4) as pool:
+            jobs = [ pool.submit(f,C) for f in [findings,assets,was,vulnerabilities] ]
+        for j in jobs:
+            j.result()
 
 if __name__ == '__main__':
     load_dotenv()
@@ -0,0 +1,55 @@
+'''Tests for the collector sinks - run with python -m pytest 01-collectors'''
+import os
+import sys
+import json
+import tempfile
+import unittest
+from unittest import mock
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ HERE, os.path.dirname(HERE) ]
+import collector
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ,{
+            'STORE_FILE'            : f"{self.tmp.name}/source/%TAG/%TENANCY.json",
+            'STORE_STATE'           : f"{self.tmp.name}/state/%TAG/%TENANCY.json",
+            'STORE_PARQUET'         : f"{self.tmp.name}/parquet/%TAG.parquet",
+            'STORE_DUCKDB'          : '',
+            'STORE_POSTGRES_HOST'   : '',
+            'STORE_AWS_S3_BUCKET'   : '',
+            'STORE_COMPRESSION'     : 'none'
+        })
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def state(self):
+        with open(f"{self.tmp.name}/state/test/{collector.Library().config['tenancy']}.json",'rt',encoding='UTF-8') as q:
+            return json.load(q)
+
+    def store(self):
+        return collector.Collector().store('test',[ { 'id' : 1 }, { 'id' : 2 } ])
+
+    def test_failed_sink_is_written_again(self):
+        with mock.patch.object(collector.ParquetSink,'close',return_value = False):
+            self.assertEqual(self.store(),2)
+        self.assertNotIn('hash',self.state())
+        self.assertFalse(os.path.exists(f"{self.tmp.name}/parquet/test.parquet"))
+
+        # -- the same data again - not skipped, as the parquet sink did not get it the first time
+        self.store()
+        self.assertIn('hash',self.state())
+        self.assertTrue(os.path.exists(f"{self.tmp.name}/parquet/test.parquet"))
+
+        # -- and now every sink has it, so it is skipped
+        with mock.patch.object(collector.ParquetSink,'close') as close:
+            self.store()
+        close.assert_not_called()
+        self.assertIn('unchanged',self.state())
+
+if __name__ == '__main__':
+    unittest.main()
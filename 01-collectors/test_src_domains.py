@@ -0,0 +1,177 @@
+'''Tests for src_domains, against a local HTTP server and a local DNS server - run with python -m pytest 01-collectors'''
+import os
+import sys
+import json
+import socket
+import asyncio
+import datetime
+import tempfile
+import threading
+import unittest
+from unittest import mock
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ HERE, os.path.dirname(HERE) ]
+import aiohttp
+from aiohttp import web
+import dns.message
+import dns.rrset
+import dns.rdatatype
+import dns.rcode
+import src_domains
+
+class StubDNS(asyncio.DatagramProtocol):
+    # == answers every TXT and MX question from RECORDS, and NXDOMAIN for anything else
+    RECORDS = {
+        ('example.test.', 'TXT') : [ '"v=spf1 -all"' ],
+        ('example.test.', 'MX')  : [ '10 mx.example.test.' ]
+    }
+
+    def connection_made(self,transport):
+        self.transport = transport
+
+    def datagram_received(self,data,addr):
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        answers = self.RECORDS.get((question.name.to_text(),dns.rdatatype.to_text(question.rdtype)))
+        if answers:
+            response.answer.append(dns.rrset.from_text(question.name,60,'IN',question.rdtype,*answers))
+        else:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        self.transport.sendto(response.to_wire(),addr)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1',0))
+        return s.getsockname()[1]
+
+class Whois:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self,domain):
+        with self.lock:
+            self.calls.append(domain)
+        return mock.Mock(expiration_date = datetime.datetime(2030,1,1), updated_date = None, creation_date = None, name_servers = [ 'ns1.example.test' ])
+
+class TestServerHeaders(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hits = 0
+        app = web.Application()
+        app.router.add_get('/',self.handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        self.port = free_port()
+        await web.TCPSite(self.runner,'127.0.0.1',self.port).start()
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def handler(self,request):
+        self.hits += 1
+        if self.hits <= self.failures:
+            return web.Response(status = [503, 429][self.hits % 2], headers = { 'Retry-After' : '0' })
+        response = web.Response(text = 'ok', headers = { 'Server' : 'stub' })
+        response.headers.add('Set-Cookie','a=1')
+        response.headers.add('Set-Cookie','b=2')
+        return response
+
+    async def test_retries_on_429_and_503(self):
+        self.failures = 2
+        stats = src_domains.new_stats()
+        headers = await src_domains.get_server_headers(self.session,f"http://127.0.0.1:{self.port}/",stats)
+        self.assertEqual(self.hits,3)
+        self.assertEqual(headers['Server'],'stub')
+        self.assertEqual(stats['http'],{ 'ok' : 1, 'errors' : 0, 'cached' : 0 })
+        self.assertEqual(stats['latency'].count,3)
+
+    async def test_gives_up_after_three_attempts(self):
+        self.failures = 5
+        stats = src_domains.new_stats()
+        headers = await src_domains.get_server_headers(self.session,f"http://127.0.0.1:{self.port}/",stats)
+        self.assertEqual(self.hits,3)
+        self.assertIn('Retry-After',headers)
+
+    async def test_folds_repeated_headers(self):
+        self.failures = 0
+        headers = await src_domains.get_server_headers(self.session,f"http://127.0.0.1:{self.port}/",src_domains.new_stats())
+        self.assertEqual(headers['Set-Cookie'],'a=1, b=2')
+
+    async def test_connection_error(self):
+        stats = src_domains.new_stats()
+        headers = await src_domains.get_server_headers(self.session,f"http://127.0.0.1:{free_port()}/",stats)
+        self.assertEqual(headers,{})
+        self.assertEqual(stats['http']['errors'],1)
+
+class TestWhois(unittest.IsolatedAsyncioTestCase):
+    async def test_ttl_cache(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cache = {
+            'fresh.test' : { 'fetched' : (now - datetime.timedelta(days = 1)).isoformat(), 'expiration_date' : 'cached' },
+            'stale.test' : { 'fetched' : (now - datetime.timedelta(days = 8)).isoformat(), 'expiration_date' : 'cached' }
+        }
+        stats = src_domains.new_stats()
+        w = Whois()
+        with mock.patch.object(src_domains.whois,'whois',w):
+            fresh = await src_domains.get_whois('fresh.test',cache,7,asyncio.Semaphore(1),stats)
+            stale = await src_domains.get_whois('stale.test',cache,7,asyncio.Semaphore(1),stats)
+            new = await src_domains.get_whois('new.test',cache,7,asyncio.Semaphore(1),stats)
+        self.assertEqual(w.calls,[ 'stale.test', 'new.test' ])
+        self.assertEqual(fresh['expiration_date'],'cached')
+        self.assertEqual(stale['expiration_date'],'2030-01-01 00:00:00')
+        self.assertEqual(cache['new.test'],new)
+        self.assertEqual(stats['whois'],{ 'ok' : 2, 'errors' : 0, 'cached' : 1 })
+
+    async def test_failure_is_not_cached(self):
+        cache = {}
+        stats = src_domains.new_stats()
+        with mock.patch.object(src_domains.whois,'whois',side_effect = Exception('refused')):
+            self.assertEqual(await src_domains.get_whois('down.test',cache,7,asyncio.Semaphore(1),stats),{})
+        self.assertEqual(cache,{})
+        self.assertEqual(stats['whois']['errors'],1)
+
+class TestCollect(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dns_port = free_port()
+        self.transport,_ = await asyncio.get_running_loop().create_datagram_endpoint(StubDNS,local_addr = ('127.0.0.1',self.dns_port))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ,{
+            'DOMAINS_NAMESERVERS'       : f"127.0.0.1:{self.dns_port}",
+            'DOMAINS_CONCURRENCY'       : '5',
+            'DOMAINS_WHOIS_CONCURRENCY' : '2',
+            'DOMAINS_WHOIS_TTL'         : '7',
+            'DOMAINS_WHOIS_CACHE'       : f"{self.tmp.name}/cache/whois.json"
+        })
+        self.env.start()
+
+    async def asyncTearDown(self):
+        self.env.stop()
+        self.transport.close()
+        self.tmp.cleanup()
+
+    async def test_collect(self):
+        w = Whois()
+        # -- the stub DNS server does not know the domains, so there is nothing for the HTTP checks to connect to
+        with mock.patch.object(src_domains.whois,'whois',w):
+            stats = src_domains.new_stats()
+            data = await src_domains.collect([ 'example.test', 'missing.test' ],stats)
+            again = await src_domains.collect([ 'example.test' ],src_domains.new_stats())
+
+        self.assertEqual([ d['domain'] for d in data ],[ 'example.test', 'missing.test' ])
+        self.assertEqual([ r.to_text() for r in data[0]['txt'] ],[ '"v=spf1 -all"' ])
+        self.assertEqual([ r.to_text() for r in data[0]['mx'] ],[ '10 mx.example.test.' ])
+        self.assertEqual(data[1]['txt'],[])
+        self.assertEqual(stats['dns'],{ 'ok' : 2, 'errors' : 2, 'cached' : 0 })
+        self.assertEqual(data[0]['expiration_date'],'2030-01-01 00:00:00')
+
+        # -- the whois cache is saved, and used by the next run
+        with open(os.environ['DOMAINS_WHOIS_CACHE'],'rt',encoding='UTF-8') as q:
+            self.assertEqual(sorted(json.load(q)),[ 'example.test', 'missing.test' ])
+        self.assertEqual(sorted(w.calls),[ 'example.test', 'missing.test' ])
+        self.assertEqual(again[0]['name_servers'],[ 'ns1.example.test' ])
+
+if __name__ == '__main__':
+    unittest.main()
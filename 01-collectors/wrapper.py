@@ -1,33 +1,132 @@
 import os
+import time
+import argparse
 import importlib
+import multiprocessing
+import queue
+import tabulate
 from dotenv import load_dotenv
 import sys
 sys.path.append('../')
 from library import Library
+import http_client
+import collector
 import logging
 
-def main():
+def plugins():
+    return sorted([ os.path.splitext(filename)[0] for filename in os.listdir('.') if filename.startswith('src') and filename.endswith('.py') ])
+
+def run(plugin,worker = False):
+    lib = Library()
+    logging.info(f"Plugin : {plugin}")
+    result = { 'plugin' : plugin, 'status' : 'ok', 'records' : 0, 'bytes' : 0 }
+    try:
+        module = importlib.import_module(plugin)
+        m = module.meta()
+        logging.info(m['title'])
+        if worker:
+            # -- other plugins are loading into the same DuckDB file at the same time
+            collector.release_duckdb = True
+        module.main()
+
+        s = collector.stats.get(m.get('plugin',m['title']),{})
+        result['records'] = s.get('records',0)
+        result['bytes'] = s.get('bytes',0)
+    except ModuleNotFoundError:
+        logging.warning(f"Plugin '{plugin}' not found.")
+        result['status'] = 'not found'
+    except Exception as e:
+        logging.error(f"Plugin '{plugin}' had an error {e}")
+        lib.alert("ERROR", f"Plugin '{plugin}' had an error {e}")
+        result['status'] = 'error'
+    return result
+
+def worker(plugin,results):
+    # -- the parent may already have used the shared HTTP session (for the Slack alert)
+    http_client.reset()
+    results.put(run(plugin,True))
+
+def run_parallel(lib,parallel,timeout):
+    # == every plugin runs in its own process, so a hung plugin can be killed without stalling the others
+    results = multiprocessing.Queue()
+    pending = plugins()
+    running = {}
+    summary = {}
+
+    while pending or running:
+        while pending and len(running) < parallel:
+            plugin = pending.pop(0)
+            p = multiprocessing.Process(target = worker, args = (plugin,results), name = plugin)
+            p.start()
+            running[plugin] = (p,time.time())
+
+        try:
+            while True:
+                r = results.get_nowait()
+                summary[r['plugin']] = r
+        except queue.Empty:
+            pass
+
+        for plugin,(p,start) in list(running.items()):
+            duration = time.time() - start
+            if not p.is_alive():
+                p.join()
+                del running[plugin]
+                summary.setdefault(plugin,{ 'plugin' : plugin, 'status' : f"exit code {p.exitcode}", 'records' : 0, 'bytes' : 0 })
+                summary[plugin]['duration'] = duration
+            elif timeout and duration > timeout:
+                logging.error(f"Plugin '{plugin}' timed out after {timeout} seconds")
+                lib.alert("ERROR", f"Plugin '{plugin}' timed out after {timeout} seconds")
+                p.terminate()
+                p.join()
+                del running[plugin]
+                summary[plugin] = { 'plugin' : plugin, 'status' : 'timeout', 'records' : 0, 'bytes' : 0, 'duration' : duration }
+        time.sleep(0.5)
+
+    # -- a result may have arrived after its process was reaped
+    try:
+        while True:
+            r = results.get_nowait()
+            if summary[r['plugin']]['status'].startswith('exit code'):
+                r['duration'] = summary[r['plugin']]['duration']
+                summary[r['plugin']] = r
+    except queue.Empty:
+        pass
+    return [ summary[p] for p in sorted(summary) ]
+
+def main(**KW):
     lib = Library()
     logging.info("Starting the collection process")
     lib.alert("INFO", "Starting the collection process")
-    for filename in os.listdir('.'):
-        if filename.startswith('src') and filename.endswith('.py'):
-            plugin = os.path.splitext(filename)[0]
-            logging.info(f"Plugin : {plugin}")
-
-            try:
-                module = importlib.import_module(plugin)
-                m = module.meta()
-                logging.info(m['title'])
-                module.main()
-            except ModuleNotFoundError:
-                logging.warning(f"Plugin '{plugin}' not found.")
-            except Exception as e:
-                logging.error(f"Plugin '{plugin}' had an error {e}")
-                lib.alert("ERROR", f"Plugin '{plugin}' had an error {e}")
-    
+
+    if KW.get('parallel',1) > 1 or KW.get('timeout'):
+        summary = run_parallel(lib,KW.get('parallel',1),KW.get('timeout'))
+    else:
+        summary = []
+        for plugin in plugins():
+            start = time.time()
+            r = run(plugin)
+            r['duration'] = time.time() - start
+            summary.append(r)
+
+    print("")
+    print(tabulate.tabulate(
+        [ [ r['plugin'], r['status'], round(r['duration'],1), r['records'], r['bytes'] ] for r in summary ],
+        headers = [ 'plugin', 'status', 'seconds', 'records', 'bytes' ]
+    ))
+    print("")
+
     logging.info("Completed with the collection process")
     lib.alert("SUCCESS", "Completed with the collection process")
+
 if __name__=='__main__':
     load_dotenv()
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Cyber Dashboard - Collectors')
+    parser.add_argument('-parallel', help='The number of plugins to run at the same time, each in its own process', type=int, default=int(os.environ.get('COLLECTOR_PARALLEL','1')))
+    parser.add_argument('-timeout', help='Kill a plugin after this many seconds (runs each plugin in its own process)', type=int, default=int(os.environ.get('COLLECTOR_TIMEOUT','0')))
+    args = parser.parse_args()
+
+    main(
+        parallel    = args.parallel,
+        timeout     = args.timeout
+    )
\ No newline at end of file
@@ -3,16 +3,50 @@ import yaml
 from jinja2 import Environment, FileSystemLoader
 import os
 import datetime
+import time
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import hashlib
 import argparse
 import tabulate
 import glob
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import sys
 from dotenv import load_dotenv
 sys.path.append('../')
 from library import Library
 import logging
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DIMENSIONS = ['business_unit','team','location']
+
+# == bump this when a change to the engine changes the results, so the result cache is not used
+CACHE_VERSION = 2
+
+# -- compliance is kept as an integer, unless a metric scores a fraction of a resource
+INTEGERS = ['BOOLEAN','TINYINT','SMALLINT','INTEGER','BIGINT','HUGEINT','UTINYINT','USMALLINT','UINTEGER','UBIGINT','UHUGEINT']
+
+def ref_table(table_name):
+    return f'"ref_{table_name.replace(chr(34),"")}"'
+
+def quote(name):
+    return '"' + name.replace('"','""') + '"'
+
+def literal(value):
+    return "'" + str(value).replace("'","''") + "'"
+
+def struct(columns):
+    # -- the columns = {...} parameter of read_json
+    return '{' + ', '.join(f"'{c.replace(chr(39),chr(39)*2)}' : '{t.replace(chr(39),chr(39)*2)}'" for c,t in columns.items()) + '}'
+
 class Metric:
     def __init__(self,**KW):
         self.lib = Library()
@@ -28,69 +62,392 @@ class Metric:
         self.datestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
         logging.info(f"Datestamp = {self.datestamp}")
         self.history = []
-        self.data_tables = {}
 
-    def resolve_ref(self, table_name):
-        self.data_tables[table_name] = f"{self.data_path}/{table_name}/*.json"
-        col = ''
-        if table_name == 'crowdstrike_hosts':
-            col = ",columns={'last_seen': 'VARCHAR','device_id' : 'VARCHAR','hostname' : 'VARCHAR'}"
+        # == one DuckDB session for the whole run.  Every ref() is read once into a table, and later queries use that table.
+        self.db = duckdb.connect(os.environ.get('METRICS_DUCKDB',':memory:'))
+        for setting,env in [ ('threads','METRICS_THREADS'), ('memory_limit','METRICS_MEMORY_LIMIT'), ('temp_directory','METRICS_TEMP_DIRECTORY') ]:
+            if os.environ.get(env,'') != '':
+                self.db.execute(f"SET {setting} = '{os.environ[env]}'")
+        self.refs = {}
+        self.ref_locks = {}
+        self.lock = threading.Lock()
+        self.failed = set()
 
-        return f"read_json('{self.data_tables[table_name]}'{col})"
-        
-    def metric_run(self,yaml_config,query,alert=False):
+        # == the schema registry, and the words used by the queries (so only the columns we need are read)
+        self.schema_path = KW.get('schema_path') or os.environ.get('METRICS_SCHEMA','../data/schema')
+        self.refresh_schema = KW.get('refresh_schema',False)
+        self.schemas = {}
+        self.used = None
+
+        # == query results are cached (as parquet) by their SQL and the files they read
+        self.cache_path = KW['cache_path'] if KW.get('cache_path') is not None else os.environ.get('METRICS_CACHE','../data/cache/metrics')
+        self.cache_size = int(os.environ.get('METRICS_CACHE_SIZE','1024')) * 1024 * 1024
+
+        # == how the dimensions of the detail are worked out - see dimensions()
+        self.joins = ''
+        self.dimension = { d : f"COALESCE(NULLIF(d.{d},'undefined'),'undefined')" for d in DIMENSIONS }
+
+        # == with -profile, every load and query keeps its timings and its DuckDB profile
+        self.profile = [] if KW.get('profile') else None
+        if self.profile is not None:
+            self.profiling(self.db)
+
+        # == the shared models (model_*.yml) that queries can ref() like a source
+        self.models = {}
+
+    def resolve_ref(self, table_name, data_tables, cursor):
+        # == queries run on many threads.  Only one of them loads a table, the others wait for it.
+        with self.lock:
+            lock = self.ref_locks.setdefault(table_name,threading.Lock())
+        with lock:
+            if table_name not in self.refs and table_name in self.models:
+                self.refs[table_name] = self.build_model(table_name,cursor)
+            elif table_name not in self.refs:
+                pattern, source = self.source(table_name)
+                if len(glob.glob(pattern)) == 0:
+                    # -- metric_run will report the missing table
+                    data_tables[table_name] = pattern
+                    return source(None)
+                start = time.time()
+                table = ref_table(table_name)
+                try:
+                    columns = self.project(self.columns(table_name,source,cursor))
+                    cursor.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM {source(columns)}")
+                    logging.info(f"Loaded {table_name} ({len(columns)} columns) in {time.time() - start:.1f}s")
+                    if self.profile is not None:
+                        # -- a load reads the source files, so its bytes are their size
+                        measured = self.profile_of(cursor)
+                        size = sum(os.path.getsize(f) for f in glob.glob(pattern))
+                        self.profile.append({ **measured, 'kind' : 'load', 'name' : table_name, 'wall_s' : time.time() - start, 'rows' : measured['rows_scanned'],
+                            'bytes_scanned' : size, 'tables' : json.dumps({ table_name : { 'rows' : measured['rows_scanned'], 'bytes' : size } }) })
+                except duckdb.Error as e:
+                    # -- the data no longer matches the registered schema, so every query using it fails straight away
+                    logging.error(f"Unable to load {table_name} : {e}")
+                    logging.error(f"If the shape of {table_name} has changed, run with -refresh_schema (or delete {self.schema_path}/{table_name}.json)")
+                    self.failed.add(table_name)
+                self.refs[table_name] = ({ table_name : pattern }, table)
+        data_tables.update(self.refs[table_name][0])
+        return self.refs[table_name][1]
+
+    def build_model(self, model_id, cursor):
+        # == a model is built once, like a source is loaded.  The queries using it depend on the sources it reads.
+        inputs = {}
+        table = ref_table(model_id)
+        env = Environment(loader=FileSystemLoader('.'))
+        env.globals['ref'] = lambda table_name: self.resolve_ref(table_name,inputs,cursor)
+        sql = env.from_string(self.models[model_id]).render()
+        missing = [ t for t in inputs if t in self.failed or len(glob.glob(inputs[t])) == 0 ]
+        if missing:
+            logging.error(f"Unable to build the model {model_id} : {', '.join(missing)} could not be loaded")
+            self.failed.add(model_id)
+            return ({ **inputs, model_id : '' }, table)
+        start = time.time()
+        try:
+            cursor.execute(f"CREATE OR REPLACE TABLE {table} AS {sql}")
+            logging.info(f"Built the model {model_id} in {time.time() - start:.1f}s")
+            if self.profile is not None:
+                measured = self.profile_of(cursor)
+                self.profile.append({ **measured, 'kind' : 'model', 'name' : model_id, 'wall_s' : time.time() - start, 'rows' : cursor.execute(f"SELECT count(*) FROM {table}").fetchone()[0] })
+        except duckdb.Error as e:
+            logging.error(f"Unable to build the model {model_id} : {e}")
+            self.failed.add(model_id)
+            return ({ **inputs, model_id : '' }, table)
+        return (inputs, table)
+
+    def source(self, table_name):
+        # == prefer the parquet copy of the data, but only when every json file has an up-to-date parquet next to it
+        # == the json files may be compressed (.json.gz or .json.zst), which DuckDB reads as they are
+        # == Returns the glob of the files, and a function giving the table function to read them with the columns we want.
+        json_files = sorted(glob.glob(f"{self.data_path}/{table_name}/*.json") + glob.glob(f"{self.data_path}/{table_name}/*.json.gz") + glob.glob(f"{self.data_path}/{table_name}/*.json.zst"))
+        parquet_files = glob.glob(f"{self.data_path}/{table_name}/*.parquet")
+        if len(parquet_files) > 0 and all(
+            os.path.exists(f"{j[:j.rindex('.json')]}.parquet") and os.path.getmtime(f"{j[:j.rindex('.json')]}.parquet") >= os.path.getmtime(j) for j in json_files
+        ):
+            pattern = f"{self.data_path}/{table_name}/*.parquet"
+            return pattern, lambda columns: f"(SELECT {', '.join(quote(c) for c in columns) if columns else '*'} FROM read_parquet({literal(pattern)}, union_by_name = true))"
+
+        pattern = f"{self.data_path}/{table_name}/*.json*"
+        if len(json_files) == 0:
+            return pattern, lambda columns: f"read_json({literal(f'{self.data_path}/{table_name}/*.json')})"
+        # -- the files are a list of SQL string literals, so a quote or a backslash in a path cannot break the query
+        files = f"[{', '.join(literal(j) for j in json_files)}]"
+        return pattern, lambda columns: f"read_json({files}, {f'columns = {struct(columns)}' if columns else 'sample_size = -1'})"
+
+    def schema(self, table_name, source, cursor):
+        # == the column types of a source, inferred over every record once and kept in the schema registry, so later
+        # == runs don't sample the data again.  Library.column_types are applied on top.
+        # == Parquet files carry their own schema, so they don't need the registry.
+        target = f"{self.schema_path}/{table_name}.json"
+        if not source(None).startswith('read_json'):
+            return { c[0] : c[1] for c in cursor.execute(f"DESCRIBE SELECT * FROM {source(None)}").fetchall() }
+        if self.refresh_schema or not os.path.exists(target):
+            columns = { c[0] : c[1] for c in cursor.execute(f"DESCRIBE SELECT * FROM {source(None)}").fetchall() }
+            os.makedirs(self.schema_path,exist_ok = True)
+            with open(target,'wt',encoding='UTF-8') as q:
+                json.dump({ 'table' : table_name, 'inferred' : datetime.datetime.now(datetime.timezone.utc).isoformat(), 'columns' : columns },q,indent = 2)
+            logging.info(f"Schema of {table_name} saved to {target}")
+        else:
+            with open(target,'rt',encoding='UTF-8') as q:
+                columns = json.load(q)['columns']
+        return { **columns, **self.lib.column_types.get(table_name,{}) }
+
+    def columns(self, table_name, source, cursor):
+        # -- the schema of a source is registered once per run.  Called with the lock of the table held.
+        if table_name not in self.schemas:
+            self.schemas[table_name] = self.schema(table_name,source,cursor)
+        return self.schemas[table_name]
+
+    def project(self, columns):
+        # == only the columns the metrics mention are read (all of them when a query selects *)
+        if self.used is None:
+            return columns
+        projected = { c : t for c,t in columns.items() if c.lower() in self.used }
+        return projected or columns
+
+    def use(self, queries):
+        # == the columns named by all the queries of this run, taken from DuckDB's parse tree of each query.  Every column
+        # == is read when a query selects * (anywhere in a select list), uses a NATURAL join or renames the columns of a
+        # == table by position, or cannot be parsed.
+        used = set()
+        def walk(node):
+            if isinstance(node,list):
+                return all(walk(n) for n in node)
+            if not isinstance(node,dict):
+                return True
+            if node.get('class') == 'STAR' or node.get('ref_type') == 'NATURAL' or node.get('column_name_alias'):
+                return False
+            used.update(c.lower() for c in node.get('column_names') or [])
+            used.update(c.lower() for c in node.get('using_columns') or [])
+            return all(walk(n) for n in node.values())
+        env = Environment(loader=FileSystemLoader('.'))
+        env.globals['ref'] = ref_table
+        for q in queries:
+            tree = json.loads(self.db.execute("SELECT json_serialize_sql(?)",[ env.from_string(q).render() ]).fetchone()[0])
+            if tree.get('error') or not walk(tree['statements']):
+                logging.info("Reading every column of the sources" + (f" - unable to parse a query : {tree.get('error_message')}" if tree.get('error') else ""))
+                self.used = None
+                return
+        self.used = used
+
+    def metric_run(self,yaml_config,query,alert=False,index=0):
         if yaml_config.get('enabled',True) == False or query == None:
             logging.info(f"Metric {yaml_config['metric_id']} is disabled")
-            return pd.DataFrame()
-        self.data_tables = {}
+            return None
+
+        # == a first pass over the template only finds the tables it uses, so we can check the result cache
+        tables = []
+        start = time.time()
         env = Environment(loader=FileSystemLoader('.'))
-        env.globals['ref'] = self.resolve_ref
+        env.globals['ref'] = lambda table_name: tables.append(table_name) or ref_table(table_name)
+        rendered = env.from_string(query).render()
+        render_s = time.time() - start
+
+        # == every query gets its own cursor (one per thread) on the shared session
+        cursor = self.db.cursor()
+        key = self.cache_key(yaml_config,rendered,tables,cursor)
+        cached = self.cache_get(key)
+        if cached is not None:
+            logging.info(f"{yaml_config['metric_id']} - Retrieved {cached.num_rows} records from the cache")
+            cursor.close()
+            return cached
+
+        data_tables = {}
+        if self.profile is not None:
+            self.profiling(cursor)
+        env = Environment(loader=FileSystemLoader('.'))
+        env.globals['ref'] = lambda table_name: self.resolve_ref(table_name,data_tables,cursor)
         template = env.from_string(query).render()
 
         # == check if the tables defined in the SQL query actually exist
         success = True
-        for table in self.data_tables:
-            if len(glob.glob(self.data_tables[table])) > 0:
+        for table in data_tables:
+            if table in self.failed:
+                logging.error(f"Table {table} could not be loaded")
+                if alert:
+                    self.lib.alert("ERROR", f"Table {table} could not be loaded")
+                success = False
+            elif len(glob.glob(data_tables[table])) > 0:
                 logging.info(f"Table {table} exists")
             else:
-                logging.error(f"Table {table} does not exist ({self.data_tables[table]})")
+                logging.error(f"Table {table} does not exist ({data_tables[table]})")
                 if alert:
-                    self.lib.alert("ERROR", f"Table {table} does not exist ({self.data_tables[table]})")
+                    self.lib.alert("ERROR", f"Table {table} does not exist ({data_tables[table]})")
                 success = False
         if not success:
-            return pd.DataFrame()
+            cursor.close()
+            return None
 
         # == execute the query
         try:
             # Execute query
-            df = duckdb.query(template).df()
-            logging.info(f"Retrieved {len(df)} records")
-            if args.dryrun:
-                print(df)
+            start = time.time()
+            rel = cursor.query(template)
+
+            # == check if the mandatory columns are there
+            success = True
+            for col in [ 'resource','resource_type','compliance','detail']:
+                if rel is None or not col in rel.columns:
+                    logging.error(f" - Column {col} does not exists.  Check the SQL in your metric defintion")
+                    if alert:
+                        self.lib.alert("ERROR", f"Column {col} does not exist. Check the SQL in your metric definition")
+                    success = False
+            if not success:
+                return None
+
+            # == the text columns and compliance are cast so every result has the same schema.  Dimensions the query did not
+            # == return are left undefined, and the rest of the metadata is joined to the detail once, at the end of the run.
+            casts = [ f"CAST({c} AS VARCHAR) AS {c}" for c in ['resource','resource_type','detail'] + [ d for d in DIMENSIONS if d in rel.columns ] ]
+            compliance = str(rel.types[rel.columns.index('compliance')])
+            casts.append(f"CAST(compliance AS {'INTEGER' if compliance in INTEGERS else 'DOUBLE'}) AS compliance")
+            added = [ f"'undefined' AS {d}" for d in DIMENSIONS if d not in rel.columns ] + [ f"'{yaml_config['metric_id'].replace(chr(39),chr(39)*2)}' AS metric_id" ]
+            table = rel.project(f"* REPLACE ({', '.join(casts)}), {', '.join(added)}").to_arrow_table()
+            logging.info(f"{yaml_config['metric_id']} - Retrieved {table.num_rows} records")
+            if self.profile is not None:
+                self.profile.append({ **self.profile_of(cursor), 'kind' : 'query', 'name' : yaml_config['metric_id'], 'query' : index,
+                    'render_s' : render_s, 'wall_s' : time.time() - start })
         except duckdb.Error as e:
             logging.error(f"Failed to execute query: {e}")
             if alert:
                 self.lib.alert("ERROR", f"Failed to execute query: {e}")
             print(template)
-            return pd.DataFrame()
-        
-        # == check if the mandatory columns are there
-        success = True
-        for col in [ 'resource','resource_type','compliance','detail']:
-            if not col in df.columns:
-                logging.error(f" - Column {col} does not exists.  Check the SQL in your metric defintion")
-                if alert:
-                    self.lib.alert("ERROR", f"Column {col} does not exist. Check the SQL in your metric definition")
-                success = False
-        if not success:
-            return pd.DataFrame()
+            return None
+        finally:
+            cursor.close()
+        self.cache_put(key,table)
+        return table
 
-        # == add the meta data
-        success = True
+    def profiling(self,cursor):
+        cursor.execute("PRAGMA enable_profiling = 'no_output'")
+        cursor.execute("SET profiling_mode = 'detailed'")
+
+    def profile_of(self,cursor):
+        # == the DuckDB profile of the last query on the cursor, with the rows and bytes read by the scan of each table
+        profile = json.loads(cursor.get_profiling_information(format = 'json'))
+        scans = {}
+        def walk(node):
+            if node.get('operator_type') == 'TABLE_SCAN':
+                info = node.get('extra_info') or {}
+                name = str(info.get('Table') or info.get('Function') or '').split('.')[-1]
+                scans.setdefault(name,{ 'rows' : 0, 'bytes' : 0 })
+                # -- table functions (read_json) don't count the rows they scan, only the rows they return
+                scans[name]['rows'] += (node.get('operator_rows_scanned') if 'Table' in info else node.get('operator_cardinality')) or 0
+                scans[name]['bytes'] += node.get('result_set_size') or 0
+            for child in node.get('children') or []:
+                walk(child)
+        walk(profile)
+        return {
+            'cpu_s'         : profile.get('cpu_time'),
+            'rows'          : profile.get('rows_returned'),
+            'rows_scanned'  : sum(t['rows'] for t in scans.values()),
+            'bytes_scanned' : sum(t['bytes'] for t in scans.values()),
+            'peak_memory'   : profile.get('system_peak_buffer_memory'),
+            'tables'        : json.dumps(scans),
+            'profile'       : json.dumps(profile)
+        }
+
+    def report(self,path,sort = 'wall_s'):
+        # == the profile is printed, slowest first, and kept as parquet (one file per run) to follow it over time
+        columns = ['kind','name','query','render_s','wall_s','cpu_s','rows','rows_scanned','bytes_scanned','peak_memory']
+        df = pd.DataFrame(self.profile,columns = columns + ['tables','profile'])
+        df.insert(0,'run',self.lib.datetime)
+        for c in ['query','rows','rows_scanned','bytes_scanned','peak_memory']:
+            df[c] = df[c].astype('Int64')
+        os.makedirs(f"{path}/profile",exist_ok = True)
+        target = f"{path}/profile/{self.lib.datetime.strftime('%Y%m%dT%H%M%S')}.parquet"
+        df.to_parquet(target,index = False)
+        if sort not in df.columns:
+            logging.warning(f"Cannot sort the profile by {sort} - using wall_s")
+            sort = 'wall_s'
+        print("")
+        print(tabulate.tabulate(df.sort_values(sort,ascending = False)[columns],headers = "keys",showindex = False,floatfmt = '.3f'))
+        print("")
+        if resource:
+            logging.info(f"Peak memory of the process : {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+        logging.info(f"Profile saved to {target}")
+
+    def cache_key(self,yaml_config,sql,tables,cursor):
+        # == the rendered SQL, the day (queries use CURRENT_DATE), and the path, size and time of every file the
+        # == query reads, along with the schema it is read with.  The schema is registered first (as the load would),
+        # == so the key is the same whether or not an earlier run had registered it.
+        if self.cache_path == '':
+            return None
+        h = hashlib.sha256(f"{CACHE_VERSION}|{self.datestamp}|{yaml_config['metric_id']}|{sql}".encode('utf-8'))
+        pending = sorted(set(tables))
+        seen = set()
+        while pending:
+            table_name = pending.pop(0)
+            if table_name in seen:
+                continue
+            seen.add(table_name)
+            if table_name in self.models:
+                # -- a model is keyed by its SQL, and the sources it reads
+                found = []
+                env = Environment(loader=FileSystemLoader('.'))
+                env.globals['ref'] = lambda t: found.append(t) or ref_table(t)
+                h.update(f"|{table_name}|{env.from_string(self.models[table_name]).render()}".encode('utf-8'))
+                pending += sorted(set(found))
+                continue
+            pattern, source = self.source(table_name)
+            files = sorted(glob.glob(pattern))
+            if len(files) == 0:
+                return None
+            for f in files:
+                st = os.stat(f)
+                h.update(f"|{f}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8'))
+            with self.lock:
+                lock = self.ref_locks.setdefault(table_name,threading.Lock())
+            try:
+                with lock:
+                    columns = self.columns(table_name,source,cursor)
+            except duckdb.Error:
+                # -- resolve_ref will report it
+                return None
+            h.update(json.dumps(columns,sort_keys = True).encode('utf-8'))
+        return h.hexdigest()
+
+    def cache_get(self,key):
+        if key is None or not os.path.exists(f"{self.cache_path}/{key}.parquet"):
+            return None
+        try:
+            table = pq.read_table(f"{self.cache_path}/{key}.parquet")
+            os.utime(f"{self.cache_path}/{key}.parquet")    # -- the least recently used results are evicted first
+            return table
+        except (OSError, pa.ArrowException) as e:
+            logging.warning(f"Unable to read {key} from the cache : {e}")
+            return None
+
+    def cache_put(self,key,table):
+        if key is None:
+            return
+        try:
+            os.makedirs(self.cache_path,exist_ok = True)
+            pq.write_table(table,f"{self.cache_path}/{key}.parquet.partial")
+            os.replace(f"{self.cache_path}/{key}.parquet.partial",f"{self.cache_path}/{key}.parquet")
+        except (OSError, pa.ArrowException) as e:
+            logging.warning(f"Unable to write {key} to the cache : {e}")
 
+    def cache_evict(self):
+        # == keep the cache under its size limit, dropping the results that were not used for the longest time
+        if self.cache_path == '' or not os.path.exists(self.cache_path):
+            return
+        files = sorted([ (os.path.getmtime(f),os.path.getsize(f),f) for f in glob.glob(f"{self.cache_path}/*.parquet") ])
+        size = sum(f[1] for f in files)
+        evicted = 0
+        while files and size > self.cache_size:
+            mtime,fsize,f = files.pop(0)
+            os.remove(f)
+            size -= fsize
+            evicted += 1
+        if evicted > 0:
+            logging.info(f"Evicted {evicted} results from the cache, {size / 1024 / 1024:.0f} MB left")
+
+    def metadata(self,yaml_config,alert=False):
+        # == the metadata of a metric, as one row of the table joined to the detail
+        success = True
+        meta = {}
         for f in ['metric_id','title','category','indicator','weight','type','description','how']:
             if f in yaml_config:
-                df[f] = yaml_config[f]
+                meta[f] = yaml_config[f]
             else:
                 logging.error(f"{f} is missing in meta data")
                 if alert:
@@ -101,68 +458,265 @@ class Metric:
         if 'slo' in yaml_config and yaml_config['slo']:
             slo_values = yaml_config['slo']
             if isinstance(slo_values, list) and len(slo_values) > 0:
-                df['slo_min'] = slo_values[0] if len(slo_values) > 0 else None
-                df['slo'] = slo_values[1] if len(slo_values) > 1 else slo_values[0]
+                meta['slo_min'] = slo_values[0] if len(slo_values) > 0 else None
+                meta['slo'] = slo_values[1] if len(slo_values) > 1 else slo_values[0]
             else:
-                df['slo'] = slo_values
-                df['slo_min'] = slo_values
+                meta['slo'] = slo_values
+                meta['slo_min'] = slo_values
         else:
-            df['slo'] = None
-            df['slo_min'] = None
+            meta['slo'] = None
+            meta['slo_min'] = None
         
         if not success:
-            return pd.DataFrame()
-        df['datestamp'] = self.datestamp
-        df['datestamp'] = pd.to_datetime(df['datestamp']).dt.date
-
-        # == Merge the resource dimensions - TODO
-        # == if we got the dimension from the query, we don't need to do anything
-        # == it is when we did not get it from the query, we need to apply it here
-        for dim in ['business_unit','team','location']:
-            if dim not in df.columns:
-                df[dim] = 'undefined'   ## TODO
-        
+            return None
+        return meta
+
+    def dimensions(self,config,alert=False):
+        # == the dimension mappings are loaded once per run into one table, keyed on the lower case resource_type and
+        # == resource, and joined to the whole detail in detail().  The prefix and pattern rules become a CASE expression
+        # == of literals, so DuckDB compiles each pattern once.
+        selects = []
+        for i,mapping in enumerate(config.get('mappings') or []):
+            data_tables = {}
+            cursor = self.db.cursor()
+            if self.profile is not None:
+                self.profiling(cursor)
+            env = Environment(loader=FileSystemLoader('.'))
+            env.globals['ref'] = lambda table_name: self.resolve_ref(table_name,data_tables,cursor)
+            sql = env.from_string(mapping['query']).render()
+            try:
+                columns = cursor.query(sql).columns
+            except duckdb.Error as e:
+                logging.warning(f"Dimension mapping {mapping.get('name',i)} skipped : {e}")
+                if alert:
+                    self.lib.alert("WARNING", f"Dimension mapping {mapping.get('name',i)} skipped : {e}")
+                continue
+            finally:
+                cursor.close()
+            if 'resource' not in columns:
+                logging.warning(f"Dimension mapping {mapping.get('name',i)} skipped : it has no resource column")
+                continue
+            resource_type = 'lower(CAST(resource_type AS VARCHAR))' if 'resource_type' in columns else 'NULL'
+            dims = [ f"NULLIF(trim(CAST({d} AS VARCHAR)),'') AS {d}" if d in columns else f"CAST(NULL AS VARCHAR) AS {d}" for d in DIMENSIONS ]
+            selects.append(f"SELECT {i} AS _mapping, {resource_type} AS resource_type, lower(CAST(resource AS VARCHAR)) AS resource, {', '.join(dims)} FROM ({sql})")
+
+        if selects:
+            start = time.time()
+            aggregates = [ f"arg_min({d},_mapping) FILTER (WHERE {d} IS NOT NULL) AS {d}" for d in DIMENSIONS ]
+            self.db.execute(f"""
+                CREATE OR REPLACE TABLE _dimensions AS
+                SELECT resource_type, resource, {', '.join(aggregates)}
+                FROM ({' UNION ALL '.join(selects)})
+                WHERE resource IS NOT NULL
+                GROUP BY ALL
+            """)
+            logging.info(f"Loaded {self.db.query('SELECT count(*) FROM _dimensions').fetchone()[0]} dimension mappings in {time.time() - start:.1f}s")
+            self.joins = """
+                LEFT JOIN _dimensions AS t ON t.resource_type = lower(d.resource_type) AND t.resource = lower(d.resource)
+                LEFT JOIN _dimensions AS a ON a.resource_type IS NULL AND a.resource = lower(d.resource)"""
+
+        rules = {}
+        for rule in config.get('rules') or []:
+            if 'prefix' in rule:
+                condition = f"starts_with(lower(d.resource),{literal(str(rule['prefix']).lower())})"
+            elif 'pattern' in rule:
+                try:
+                    self.db.execute("SELECT regexp_matches('',?,'i')",[ str(rule['pattern']) ])
+                except duckdb.Error as e:
+                    logging.warning(f"Dimension rule {rule} skipped : {e}")
+                    continue
+                condition = f"regexp_matches(d.resource,{literal(rule['pattern'])},'i')"
+            else:
+                logging.warning(f"Dimension rule {rule} skipped : it needs a prefix or a pattern")
+                continue
+            if 'resource_type' in rule:
+                condition = f"lower(d.resource_type) = {literal(str(rule['resource_type']).lower())} AND {condition}"
+            for d in DIMENSIONS:
+                if d in rule:
+                    rules.setdefault(d,[]).append(f"WHEN {condition} THEN {literal(rule[d])}")
+
+        # -- a dimension returned by the query wins, then the mappings (on the resource_type, then any type), then the rules
+        for d in DIMENSIONS:
+            terms = [ f"NULLIF(d.{d},'undefined')" ]
+            if selects:
+                terms += [ f"t.{d}", f"a.{d}" ]
+            if d in rules:
+                terms.append(f"CASE {' '.join(rules[d])} END")
+            self.dimension[d] = f"COALESCE({', '.join(terms + [ chr(39) + 'undefined' + chr(39) ])})"
+
+    def detail(self,tables,metadata):
+        # == all the results are concatenated once, and the metadata joined to them in a single pass.  Several files can
+        # == share a metric_id, so each result carries the index (_file) of the metadata of the file it came from.
+        detail = pa.concat_tables(tables, promote_options = 'permissive')
+        detail = detail.append_column('_row',pa.array(range(detail.num_rows),pa.int64()))
+        self.db.register('_detail',detail)
+        self.db.register('_metadata',pa.Table.from_pylist(metadata))
+        start = time.time()
+        df = self.db.query(f"""
+            SELECT d.* EXCLUDE (_row, _file) REPLACE ({', '.join(f"{e} AS {d}" for d,e in self.dimension.items())}), m.* EXCLUDE (metric_id, _file), DATE '{self.datestamp}' AS datestamp
+            FROM _detail AS d{self.joins}
+            JOIN _metadata AS m ON m._file = d._file
+            ORDER BY d._row
+        """).df()
+        if self.profile is not None:
+            self.profile.append({ **self.profile_of(self.db), 'kind' : 'detail', 'name' : 'detail', 'wall_s' : time.time() - start })
+        self.db.unregister('_detail')
+        self.db.unregister('_metadata')
+        df['datestamp'] = df['datestamp'].dt.date
         return df
 
+def normalise_summary(df_summary):
+    df_summary['datestamp'] = pd.to_datetime(df_summary['datestamp'], errors='coerce').dt.strftime('%Y-%m-%d')
+    if 'indicator' not in df_summary.columns:
+        df_summary['indicator'] = False
+    df_summary['indicator'] = df_summary['indicator'].fillna('').astype(str).str.lower() == 'true'
+    return df_summary
+
+def save_partition(lib,path,datestamp,df,upload = True):
+    # == a partition is written next to the dataset first, and then swapped in
+    partition = f"{path}/summary/datestamp={datestamp}"
+    partial = f"{path}/summary.partial/datestamp={datestamp}"
+    os.makedirs(partial, exist_ok = True)
+    df.drop(columns = ['datestamp']).to_parquet(f"{partial}/part-0.parquet", index = False)
+    if os.path.exists(partition):
+        shutil.rmtree(partition)
+    os.makedirs(f"{path}/summary", exist_ok = True)
+    os.replace(partial, partition)
+    if upload and os.environ.get('STORE_AWS_S3_BUCKET','') != '':
+        lib.upload_to_s3(f"{partition}/part-0.parquet",os.environ['STORE_AWS_S3_BUCKET'],f"summary/datestamp={datestamp}/part-0.parquet")
+
+def migrate_summary(lib,path):
+    # == a summary.parquet from before the summary history was partitioned is split up, once
+    bucket = os.environ.get('STORE_AWS_S3_BUCKET','')
+    legacy = f"{path}/summary.parquet"
+    if os.path.exists(f"{path}/summary"):
+        return
+    published = bucket != '' and lib.exists_in_s3(bucket,'summary/')
+    if bucket != '' and not published and not os.path.exists(legacy) and lib.exists_in_s3(bucket,'summary.parquet'):
+        lib.download_from_s3(bucket,'summary.parquet',target = 'file',parameter = legacy)
+    if os.path.exists(legacy):
+        logging.info(f"Splitting {legacy} into the partitioned summary history")
+        for datestamp,df in normalise_summary(pd.read_parquet(legacy)).dropna(subset = ['datestamp']).groupby('datestamp'):
+            save_partition(lib,path,datestamp,df,upload = not published)
+
+def sync_summary(lib,path,datestamps = None):
+    # == the partitions of the days a run rewrites are downloaded from S3 when they are not here (on a fresh runner), so
+    # == the metrics of that day it did not run are kept.  Without datestamps, every partition missing here is downloaded.
+    bucket = os.environ.get('STORE_AWS_S3_BUCKET','')
+    if bucket == '':
+        return
+    if datestamps is None:
+        missing = [ key for key in lib.list_s3(bucket,'summary/') if key.endswith('.parquet') and not os.path.exists(f"{path}/{key}") ]
+    else:
+        missing = [ key for key in [ f"summary/datestamp={d}/part-0.parquet" for d in datestamps ] if not os.path.exists(f"{path}/{key}") and lib.exists_in_s3(bucket,key) ]
+    if missing:
+        logging.info(f"Downloading {len(missing)} summary partitions from s3://{bucket}/summary/")
+    for key in missing:
+        os.makedirs(os.path.dirname(f"{path}/{key}"), exist_ok = True)
+        lib.download_from_s3(bucket,key,target = 'file',parameter = f"{path}/{key}")
+
+def publish_legacy_summary(lib,path):
+    # == summary.parquet (the whole history in one file) is only written and uploaded for the consumers that still read it,
+    # == with METRICS_SUMMARY_LEGACY=true.  It needs the whole history, so its cost grows with it.
+    if os.environ.get('METRICS_SUMMARY_LEGACY','false').lower() != 'true':
+        return
+    sync_summary(lib,path)
+    df = pd.read_parquet(f"{path}/summary")
+    df['datestamp'] = df['datestamp'].astype(str)
+    df = df[['datestamp'] + [ c for c in df.columns if c != 'datestamp' ]]
+    df.to_parquet(f"{path}/summary.parquet.partial", index = False)
+    os.replace(f"{path}/summary.parquet.partial",f"{path}/summary.parquet")
+    logging.info(f"Saved {len(df)} summary records to {path}/summary.parquet (deprecated - read {path}/summary instead)")
+    if os.environ.get('STORE_AWS_S3_BUCKET','') != '':
+        lib.upload_to_s3(f"{path}/summary.parquet",os.environ['STORE_AWS_S3_BUCKET'],'summary.parquet')
+
+def write_summary(lib,path,df_summary):
+    # == the summary history is a hive partitioned dataset - summary/datestamp=YYYY-MM-DD/part-0.parquet.  A run only rewrites the days
+    # == it has data for (keeping any metrics of that day it did not run), so the cost of a run does not grow with the history.
+    migrate_summary(lib,path)
+    df_summary = normalise_summary(df_summary)
+    sync_summary(lib,path,sorted(df_summary['datestamp'].dropna().unique()))
+    for datestamp,df in df_summary.groupby('datestamp'):
+        current = f"{path}/summary/datestamp={datestamp}/part-0.parquet"
+        if os.path.exists(current):
+            existing = pd.read_parquet(current)
+            existing = existing[~existing['metric_id'].isin(df['metric_id'])]
+            df = pd.concat([df, existing.assign(datestamp = datestamp)], ignore_index = True)
+        logging.info(f"Saving {len(df)} summary records to {path}/summary/datestamp={datestamp}")
+        save_partition(lib,path,datestamp,df)
+    if os.path.exists(f"{path}/summary.partial"):
+        shutil.rmtree(f"{path}/summary.partial")
+    publish_legacy_summary(lib,path)
+
 def main(**KW):
     load_dotenv()
     lib = Library()
-    M = Metric(data_path = KW['data_path'])
+    M = Metric(data_path = KW['data_path'], schema_path = KW.get('schema'), refresh_schema = KW.get('refresh_schema',False), cache_path = '' if KW.get('nocache') or KW.get('profile') else KW.get('cache'), profile = KW.get('profile'))
 
     # should we send an alert?
     alert = not (KW.get('dryrun') or KW.get('metric'))
 
-    df_detail = pd.DataFrame()
-
-    for filename in os.listdir(KW['metric_path']):
+    metrics = []
+    for filename in sorted(os.listdir(KW['metric_path'])):
         if filename.startswith('metric_') and filename.endswith('.yml'):
             metric_file = os.path.splitext(filename)[0]
             with open(f"{KW['metric_path']}/{metric_file}.yml",'rt') as y:
                 metric = yaml.safe_load(y)
             
             if KW['metric'] == None or KW['metric'] == metric_file or KW['metric'] == metric['metric_id']:
-                logging.info("-----------------------------------------------------------------------")
-                logging.info(f"Metric : {metric_file}")
-                df_metric = pd.DataFrame()
-                if 'query' in metric and metric['query'] != None:
-                    for i,query in enumerate(metric['query']):
-                        df = M.metric_run(metric,query,alert)
-                        if df.empty:
-                            logging.warning(f"The metric {metric_file} query ({i}) returned an empty dataset.")
-                        else:
-                            df_metric = pd.concat([df_metric, df], ignore_index=True)
-                
-                    if df_metric.empty:
-                        logging.error(f"The metric {metric_file} had no data returned.  It will not be counted.")
-                        if alert:
-                            M.lib.alert("ERROR", f"The metric {metric_file} had no data returned.  It will not be counted.")
-                    else:
-                        if KW['metric'] != None:
-                            print(df_metric)
-
-                    df_detail = pd.concat([df_detail, df_metric], ignore_index=True)
+                metrics.append((metric_file,metric))
+        elif filename.startswith('model_') and filename.endswith('.yml'):
+            with open(f"{KW['metric_path']}/{filename}",'rt') as y:
+                model = yaml.safe_load(y)
+            M.models[model['model_id']] = model['query']
+
+    dimensions = {}
+    if os.path.exists(KW.get('dimensions') or ''):
+        with open(KW['dimensions'],'rt') as y:
+            dimensions = yaml.safe_load(y) or {}
+
+    M.use([ q for f,m in metrics for q in (m.get('query') or []) if q ] + list(M.models.values()) + [ m['query'] for m in dimensions.get('mappings') or [] ])
+    M.dimensions(dimensions,alert)
+
+    # == every query of every metric runs on the pool.  The results are picked up in file and query order, so the run is deterministic.
+    jobs = {}
+    metadata = {}
+    with ThreadPoolExecutor(max_workers = KW.get('parallel') or os.cpu_count()) as pool:
+        for metric_file,metric in metrics:
+            if 'query' in metric and metric['query'] != None:
+                metadata[metric_file] = M.metadata(metric,alert)
+                jobs[metric_file] = [ pool.submit(M.metric_run,metric,query,alert,i) for i,query in enumerate(metric['query']) ] if metadata[metric_file] else []
+
+    tables = []
+    files = []
+    for metric_file,metric in metrics:
+        logging.info("-----------------------------------------------------------------------")
+        logging.info(f"Metric : {metric_file}")
+        if metric_file in jobs:
+            results = []
+            for i,job in enumerate(jobs[metric_file]):
+                table = job.result()
+                if table is None or table.num_rows == 0:
+                    logging.warning(f"The metric {metric_file} query ({i}) returned an empty dataset.")
                 else:
-                    logging.warning(f"No query found in {metric_file}.yml.  It will not be counted.")
+                    if KW.get('dryrun'):
+                        print(table.to_pandas())
+                    results.append(table)
+        
+            if len(results) == 0:
+                logging.error(f"The metric {metric_file} had no data returned.  It will not be counted.")
+                if alert:
+                    M.lib.alert("ERROR", f"The metric {metric_file} had no data returned.  It will not be counted.")
+            else:
+                tables += [ t.append_column('_file',pa.array([ len(files) ] * t.num_rows,pa.int32())) for t in results ]
+                files.append({ **metadata[metric_file], '_file' : len(files) })
+        else:
+            logging.warning(f"No query found in {metric_file}.yml.  It will not be counted.")
+
+    df_detail = M.detail(tables,files) if tables else pd.DataFrame()
+    M.cache_evict()
+    if KW['metric'] != None:
+        print(df_detail)
     if df_detail.empty:
         logging.error("The detail dataframe is empty - are you sure the metrics ran ok?")
         if alert:
@@ -176,6 +730,8 @@ def main(**KW):
     print("")
     print(tabulate.tabulate(summary,headers="keys",showindex=False))
     print("")
+    if M.profile is not None:
+        M.report(KW['parquet'],KW['profile'])
 
     # == save the data file to be used by the publish process
     logging.info("Saving the detail data to parquet")
@@ -199,37 +755,7 @@ def main(**KW):
     df_summary = df_detail.groupby(primary_columns + new_columns).agg({'compliance' : ['sum','count']}).reset_index()
     df_summary.columns = primary_columns + new_columns + ['totalok', 'total']
 
-    ## IMPORTANT ## 
-    # before we merge the data, we need to check if the local parquet file already exists.  If it does, we won't be grabbing it from S3.
-    if not os.path.exists(f"{KW['parquet']}/summary.parquet") and 'STORE_AWS_S3_BUCKET' in os.environ:
-        lib.download_from_s3(os.environ['STORE_AWS_S3_BUCKET'],'summary.parquet',target = f"{KW['parquet']}/summary.parquet",parameter = None)
-
-    if os.path.exists(f"{KW['parquet']}/summary.parquet"):
-        orig_summary_df = pd.read_parquet(f"{KW['parquet']}/summary.parquet")
-
-        # Ensure the columns exist in both DataFrames
-        if 'metric_id' in orig_summary_df.columns and 'datestamp' in orig_summary_df.columns:
-            # Get a set of metric_id and datestamp pairs to remove
-            to_remove = set(zip(df_summary['metric_id'], df_summary['datestamp']))
-
-            # Filter the original DataFrame to exclude rows matching any of the pairs
-            orig_summary_df = orig_summary_df[
-                ~orig_summary_df[['metric_id', 'datestamp']].apply(tuple, axis=1).isin(to_remove)
-            ]
-
-        # Concatenate the updated original DataFrame with the new summary
-        df_summary = pd.concat([df_summary, orig_summary_df], ignore_index=True)
-
-    df_summary['datestamp'] = pd.to_datetime(df_summary['datestamp'], errors='coerce')
-    df_summary['datestamp'] = pd.to_datetime(df_summary['datestamp'], errors='coerce').dt.strftime('%Y-%m-%d')
-
-    if 'indicator' not in df_summary.columns:
-        df_summary['indicator'] = False
-    df_summary['indicator'] = df_summary['indicator'].fillna('').astype(str).str.lower() == 'true'
-    
-    df_summary.to_parquet(f"{KW['parquet']}/summary.parquet", index=False)
-    if 'STORE_AWS_S3_BUCKET' in os.environ:
-        lib.upload_to_s3(f"{KW['parquet']}/summary.parquet",os.environ['STORE_AWS_S3_BUCKET'],'summary.parquet')
+    write_summary(lib,KW['parquet'],df_summary)
 
     logging.info("Metric generation completed")
     if alert:
@@ -242,6 +768,13 @@ if __name__=='__main__':
     parser.add_argument('-path',help='The path where the metric yaml files are stored',default='.')
     parser.add_argument('-data',help='The path where the collector saves its files',default=os.environ.get('STORE_FILE','../data/source'))
     parser.add_argument('-parquet',help='The path where the metrics saves the resulting parquet file',default='../data')
+    parser.add_argument('-schema',help='The path of the schema registry',default=os.environ.get('METRICS_SCHEMA','../data/schema'))
+    parser.add_argument('-refresh_schema', help='Infer the schema of every source again', action='store_true')
+    parser.add_argument('-cache',help='The path of the query result cache',default=os.environ.get('METRICS_CACHE','../data/cache/metrics'))
+    parser.add_argument('-nocache', help='Run every query, without using the result cache', action='store_true')
+    parser.add_argument('-dimensions',help='The dimension mappings of the resources',default=os.environ.get('METRICS_DIMENSIONS','dimensions.yml'))
+    parser.add_argument('-profile',help='Profile every load and query, sorting the report by a column (wall_s by default)',nargs='?',const='wall_s')
+    parser.add_argument('-parallel',help='The number of queries to run at the same time',type=int,default=int(os.environ.get('METRICS_PARALLEL','0')) or os.cpu_count())
 
     args = parser.parse_args()
 
@@ -250,5 +783,12 @@ if __name__=='__main__':
         data_path       = args.data,
         dryrun          = args.dryrun,
         metric          = args.metric,
-        parquet         = args.parquet
+        parquet         = args.parquet,
+        parallel        = args.parallel,
+        schema          = args.schema,
+        refresh_schema  = args.refresh_schema,
+        cache           = args.cache,
+        nocache         = args.nocache,
+        dimensions      = args.dimensions,
+        profile         = args.profile
     )
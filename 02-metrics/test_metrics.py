@@ -0,0 +1,100 @@
+'''Tests for the metrics engine - run with python -m pytest 02-metrics'''
+import os
+import sys
+import json
+import tempfile
+import unittest
+from unittest import mock
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ HERE, os.path.dirname(HERE) ]
+import metrics
+
+def metric(metric_id,compliance):
+    return {
+        'metric_id' : metric_id, 'title' : metric_id, 'category' : 'test', 'indicator' : False, 'weight' : 1,
+        'type' : 'percentage', 'description' : metric_id, 'how' : metric_id, 'slo' : [ 0.9, 0.95 ],
+        'query' : [ f"SELECT login AS resource, 'user' AS resource_type, {compliance} AS compliance, status AS detail FROM {{{{ ref('users') }}}}" ]
+    }
+
+class TestDetail(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(f"{self.tmp.name}/source/users")
+        with open(f"{self.tmp.name}/source/users/test.json",'wt',encoding='UTF-8') as q:
+            json.dump([ { 'login' : 'a', 'status' : 'ACTIVE' }, { 'login' : 'b', 'status' : 'SUSPENDED' } ],q)
+        self.M = metrics.Metric(data_path = f"{self.tmp.name}/source", schema_path = f"{self.tmp.name}/schema", cache_path = '')
+
+    def tearDown(self):
+        self.M.db.close()
+        self.tmp.cleanup()
+
+    def detail(self,*configs):
+        tables = []
+        files = []
+        for i,config in enumerate(configs):
+            table = self.M.metric_run(config,config['query'][0])
+            tables.append(table.append_column('_file',metrics.pa.array([ i ] * table.num_rows,metrics.pa.int32())))
+            files.append({ **self.M.metadata(config), '_file' : i })
+        return self.M.detail(tables,files)
+
+    def test_bool_and_int_compliance(self):
+        df = self.detail(
+            metric('int',"CASE WHEN status = 'ACTIVE' THEN 1 ELSE 0 END"),
+            metric('bool',"status = 'ACTIVE'")
+        )
+        self.assertEqual(df.groupby('metric_id')['compliance'].sum().to_dict(),{ 'int' : 1, 'bool' : 1 })
+        self.assertEqual(str(df['compliance'].dtype),'int32')
+
+    def test_fractional_compliance(self):
+        df = self.detail(
+            metric('int',"CASE WHEN status = 'ACTIVE' THEN 1 ELSE 0 END"),
+            metric('fraction',"CASE WHEN status = 'ACTIVE' THEN 1 ELSE 0.5 END")
+        )
+        self.assertEqual(df.groupby('metric_id')['compliance'].sum().to_dict(),{ 'int' : 1, 'fraction' : 1.5 })
+
+class TestSource(unittest.TestCase):
+    def test_path_with_quote_and_backslash(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data = f"{tmp}/it's a \\ path"
+            os.makedirs(f"{data}/users")
+            for i in range(2):
+                with open(f"{data}/users/{i}'.json",'wt',encoding='UTF-8') as q:
+                    json.dump([ { 'login' : f"user{i}" } ],q)
+            M = metrics.Metric(data_path = data, schema_path = f"{tmp}/schema", cache_path = '')
+            cursor = M.db.cursor()
+            table = M.resolve_ref('users',{},cursor)
+            self.assertNotIn('users',M.failed)
+            self.assertEqual(sorted(r[0] for r in cursor.execute(f"SELECT login FROM {table}").fetchall()),[ 'user0', 'user1' ])
+            cursor.close()
+            M.db.close()
+
+class TestSummary(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lib = mock.Mock()
+        self.lib.list_s3.return_value = [ f"summary/datestamp=2024-01-0{d}/part-0.parquet" for d in range(1,4) ]
+        self.lib.exists_in_s3.side_effect = lambda bucket,key: key != 'summary.parquet'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self,**env):
+        df = metrics.pd.DataFrame([ { 'datestamp' : '2024-01-03', 'metric_id' : 'm', 'business_unit' : 'undefined', 'totalok' : 1, 'total' : 2 } ])
+        with mock.patch.dict(os.environ,{ 'STORE_AWS_S3_BUCKET' : 'bucket', **env }):
+            metrics.write_summary(self.lib,self.tmp.name,df)
+
+    def test_only_the_days_written_are_synced(self):
+        self.write()
+        self.lib.list_s3.assert_not_called()
+        self.assertEqual([ c.args[1] for c in self.lib.download_from_s3.call_args_list ],[ 'summary/datestamp=2024-01-03/part-0.parquet' ])
+        self.assertFalse(os.path.exists(f"{self.tmp.name}/summary.parquet"))
+
+    def test_legacy_summary_is_opt_in(self):
+        self.lib.download_from_s3.side_effect = lambda bucket,key,target,parameter: None
+        self.write(METRICS_SUMMARY_LEGACY = 'true')
+        self.lib.list_s3.assert_called_once()
+        self.assertTrue(os.path.exists(f"{self.tmp.name}/summary.parquet"))
+        self.assertIn(mock.call(f"{self.tmp.name}/summary.parquet",'bucket','summary.parquet'),self.lib.upload_to_s3.call_args_list)
+
+if __name__ == '__main__':
+    unittest.main()
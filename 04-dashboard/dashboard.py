@@ -12,7 +12,14 @@ def convert(input_path, output_path):
         parquet_file = f"{input_path}/{x}.parquet"
         json_file = f"{output_path}/{x}.json"
         
-        if os.path.exists(parquet_file):
+        if x == 'summary' and os.path.isdir(f"{input_path}/summary"):
+            # -- the summary history is partitioned by datestamp - reading the directory merges the partitions
+            parquet_file = f"{input_path}/summary"
+            df = pd.read_parquet(parquet_file)
+            df['datestamp'] = df['datestamp'].astype(str)
+            df.to_json(json_file, orient="records", indent=2)
+            print(f"Converted {parquet_file} to {json_file}")
+        elif os.path.exists(parquet_file):
             df = pd.read_parquet(parquet_file)
             df.to_json(json_file, orient="records", indent=2)
             print(f"Converted {parquet_file} to {json_file}")
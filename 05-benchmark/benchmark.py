@@ -0,0 +1,135 @@
+import argparse
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import datetime
+import shutil
+import pyarrow.parquet as pq
+import tabulate
+sys.path.append('../')
+import logging
+from library import Library
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def run(stage,command,cwd,env,log):
+    # == every stage runs in its own process, so wait4() gives us its own CPU time and peak memory
+    logging.info(f"{stage} - {' '.join(command)}")
+    start = time.time()
+    with open(log,'wt',encoding='UTF-8') as q:
+        p = subprocess.Popen(command,cwd = cwd,env = env,stdout = q,stderr = subprocess.STDOUT)
+        _,status,usage = os.wait4(p.pid,0)
+    seconds = time.time() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        logging.error(f"{stage} failed - see {log}")
+        exit(1)
+    # -- ru_maxrss is in KB on Linux, and in bytes on macOS
+    peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return { 'seconds' : round(seconds,3), 'cpu_s' : round(usage.ru_utime + usage.ru_stime,3), 'peak_mb' : round(peak,1) }
+
+def benchmark(hosts,work,KW):
+    source = f"{work}/{hosts}/source"
+    out = f"{work}/{hosts}/out"
+    os.makedirs(out,exist_ok = True)
+
+    # -- nothing leaves the machine - no S3, no Slack, no dashboard upload
+    env = { **os.environ, 'STORE_AWS_S3_BUCKET' : '', 'SLACK_WEBHOOK' : '', 'CYBER_DASHBOARD_ENDPOINT' : '', 'CYBER_DASHBOARD_TOKEN' : '' }
+    results = {}
+
+    results['generate'] = run('generate',[ sys.executable, 'generate.py', '-hosts', str(hosts), '-data', source ] + (['-parquet'] if KW.get('parquet') else []),HERE,env,f"{work}/{hosts}/generate.log")
+    with open(f"{source}/manifest.json",'rt',encoding='UTF-8') as q:
+        records = sum(json.load(q)['tables'].values())
+    results['generate']['rows'] = records
+
+    # -- the schema is inferred again and the result cache is not used, so every run does the same work
+    command = [ sys.executable, 'metrics.py', '-data', source, '-parquet', out, '-schema', f"{work}/{hosts}/schema", '-refresh_schema', '-nocache' ]
+    if KW.get('parallel'):
+        command += [ '-parallel', str(KW['parallel']) ]
+    results['metrics'] = run('metrics',command,f"{ROOT}/02-metrics",env,f"{work}/{hosts}/metrics.log")
+    results['metrics']['rows'] = records
+
+    results['publish'] = run('publish',[ sys.executable, 'publish.py', '-parquet', f"{out}/detail.parquet" ],f"{ROOT}/03-publish",env,f"{work}/{hosts}/publish.log")
+    results['publish']['rows'] = pq.read_metadata(f"{out}/detail.parquet").num_rows
+
+    for stage in results:
+        results[stage]['rows_per_s'] = round(results[stage]['rows'] / max(results[stage]['seconds'],0.001))
+    return results
+
+def compare(hosts,results,baseline,threshold):
+    # == a stage has regressed when it is slower, or uses more memory, than the baseline by more than the threshold (%)
+    regressed = False
+    table = []
+    for stage,r in results.items():
+        b = baseline.get(str(hosts),{}).get('stages',{}).get(stage)
+        row = { 'stage' : stage, 'seconds' : r['seconds'], 'cpu_s' : r['cpu_s'], 'peak_mb' : r['peak_mb'], 'rows' : r['rows'], 'rows/s' : r['rows_per_s'] }
+        if b:
+            time_change = (r['seconds'] - b['seconds']) / max(b['seconds'],0.001) * 100
+            memory_change = (r['peak_mb'] - b['peak_mb']) / max(b['peak_mb'],0.001) * 100
+            row.update({ 'baseline_s' : b['seconds'], 'time %' : f"{time_change:+.1f}", 'baseline_mb' : b['peak_mb'], 'memory %' : f"{memory_change:+.1f}" })
+            if time_change > threshold or memory_change > threshold:
+                logging.warning(f"{hosts} hosts - {stage} has regressed ({time_change:+.1f}% time, {memory_change:+.1f}% memory)")
+                regressed = True
+        table.append(row)
+    print("")
+    print(f"{hosts} hosts")
+    print(tabulate.tabulate(table,headers = "keys",showindex = False))
+    print("")
+    return regressed
+
+def main(**KW):
+    Library()
+    work = os.path.abspath(KW['work'])
+    baseline = {}
+    if os.path.exists(KW['baseline']):
+        with open(KW['baseline'],'rt',encoding='UTF-8') as q:
+            baseline = json.load(q)
+    else:
+        logging.warning(f"No baseline found in {KW['baseline']} - run with -save to record one")
+
+    regressed = False
+    for hosts in KW['hosts']:
+        results = benchmark(hosts,work,KW)
+        regressed = compare(hosts,results,baseline,KW['threshold']) or regressed
+        if KW.get('save'):
+            baseline[str(hosts)] = {
+                'recorded'  : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'machine'   : f"{platform.node()} ({platform.machine()}, {os.cpu_count()} cpus, python {platform.python_version()})",
+                'stages'    : results
+            }
+        if not KW.get('keep'):
+            shutil.rmtree(f"{work}/{hosts}")
+
+    if KW.get('save'):
+        with open(KW['baseline'],'wt',encoding='UTF-8') as q:
+            json.dump(baseline,q,indent = 2)
+        logging.info(f"Baseline saved to {KW['baseline']}")
+    if regressed and not KW.get('save'):
+        exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cyber Dashboard - End to end benchmark')
+    parser.add_argument('-hosts',help='The scales to run, as a number of hosts',type=int,nargs='+',default=[10000])
+    parser.add_argument('-work',help='The working directory for the generated data and results',default='../data/benchmark')
+    parser.add_argument('-baseline',help='The baseline to compare against',default=f"{HERE}/baseline.json")
+    parser.add_argument('-save',help='Save the results as the new baseline',action='store_true')
+    parser.add_argument('-threshold',help='The increase (%%) in time or memory over the baseline that counts as a regression',type=float,default=20)
+    parser.add_argument('-parallel',help='Passed on to metrics.py',type=int)
+    parser.add_argument('-parquet',help='Generate a parquet copy of the sources as well',action='store_true')
+    parser.add_argument('-keep',help='Keep the generated data and results',action='store_true')
+
+    args = parser.parse_args()
+
+    main(
+        hosts       = args.hosts,
+        work        = args.work,
+        baseline    = args.baseline,
+        save        = args.save,
+        threshold   = args.threshold,
+        parallel    = args.parallel,
+        parquet     = args.parquet,
+        keep        = args.keep
+    )
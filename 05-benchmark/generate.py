@@ -0,0 +1,273 @@
+import duckdb
+import argparse
+import os
+import json
+import time
+import datetime
+import sys
+sys.path.append('../')
+import logging
+from library import Library
+
+# == the sources the metrics read, following schema.md.  Every value comes from hash() of the row number, and every
+# == date is counted back from the reference date (anchor), so the same scale and date always give the same data,
+# == however many threads DuckDB uses.
+MACROS = [
+    "CREATE MACRO anchor() AS TIMESTAMP '{date}'",
+    "CREATE MACRO rnd(i, salt) AS (hash(i, salt) % 1000000) / 1000000.0",
+    "CREATE MACRO pick(i, salt, l) AS l[1 + CAST(hash(i, salt) % len(l) AS INTEGER)]",
+    "CREATE MACRO ago(i, salt, days) AS anchor() - to_seconds(CAST(rnd(i, salt) * days * 86400 AS BIGINT))"
+]
+
+def tables(hosts):
+    users = max(hosts // 2,1)
+    groups = max(users // 50,1)
+    projects = max(hosts // 100,1)
+    orgs = max(projects // 20,1)
+    domains = max(hosts // 1000,50)
+    apps = max(hosts // 500,1)
+    return {
+        'crowdstrike_hosts' : f"""
+            SELECT
+                md5(i || 'cs') AS device_id,
+                'host' || i AS hostname,
+                strftime(ago(i, 'cs_seen', 40), '%Y-%m-%dT%H:%M:%SZ') AS last_seen,
+                strftime(ago(i, 'cs_first', 900), '%Y-%m-%dT%H:%M:%SZ') AS first_seen,
+                pick(i, 'cs_os', ['Windows', 'Linux', 'Mac']) AS platform_name,
+                pick(i, 'cs_version', ['Windows 11', 'Windows Server 2022', 'Ubuntu 22.04', 'macOS 14']) AS os_version,
+                pick(i, 'cs_type', ['Workstation', 'Server']) AS product_type_desc,
+                '7.' || (10 + hash(i, 'cs_agent') % 8) || '.0' AS agent_version,
+                '10.' || (i // 65536 % 256) || '.' || (i // 256 % 256) || '.' || (i % 256) AS local_ip,
+                'normal' AS status,
+                {{ 'sensor_update' : 'platform_default' }} AS device_policies
+            FROM range({hosts}) t(i)""",
+        'crowdstrike_vulnerabilities' : f"""
+            SELECT
+                md5(k || 'csv') AS id,
+                md5(i || 'cs') AS aid,
+                pick(k, 'status', ['open', 'reopen', 'closed']) AS status,
+                pick(k, 'severity', ['LOW', 'MEDIUM', 'HIGH', 'CRITICAL']) AS severity,
+                ago(k, 'published', 60) AS published_date,
+                ago(k, 'created', 30) AS created_timestamp,
+                ago(k, 'updated', 5) AS updated_timestamp,
+                {{ 'id' : 'CVE-2024-' || (1000 + hash(k, 'cve') % 9000), 'remediation_level' : pick(k, 'level', ['O', 'U', NULL]), 'exploit_status' : pick(k, 'exploit', [0, 30, 60, 90]) }} AS cve,
+                {{ 'entities' : [ {{ 'title' : 'Update ' || pick(k, 'title', ['Chrome', 'OpenSSL', 'Kernel']) }} ] }} AS remediation,
+                [ {{ 'product_name_version' : pick(k, 'app', ['Chrome 120', 'OpenSSL 3.0', 'Kernel 6.1']) }} ] AS apps
+            FROM (SELECT i, i * 7 + unnest(range(CAST(hash(i, 'cs_n') % 7 AS BIGINT))) AS k FROM range({hosts}) t(i))""",
+        'tenable_assets' : f"""
+            SELECT
+                md5(i || 'tio') AS uuid,
+                'host' || i AS hostname,
+                ago(i, 'tio_seen', 40) AS last_seen,
+                ago(i, 'tio_first', 900) AS first_seen,
+                [ '10.' || (i // 65536 % 256) || '.' || (i // 256 % 256) || '.' || (i % 256) ] AS ipv4s,
+                [ 'host' || i || '.example.com' ] AS fqdns,
+                [ pick(i, 'tio_os', ['Microsoft Windows 11', 'Linux Kernel 5.15', 'Mac OS X 14']) ] AS operating_systems,
+                CAST(NULL AS VARCHAR) AS deleted_at
+            FROM range({hosts}) t(i)""",
+        'tenable_vulnerabilities' : f"""
+            SELECT
+                {{ 'uuid' : md5(i || 'tio'), 'hostname' : 'host' || i }} AS asset,
+                pick(k, 'state', ['OPEN', 'REOPENED', 'FIXED']) AS state,
+                pick(k, 'severity', ['low', 'medium', 'high', 'critical']) AS severity,
+                {{ 'port' : pick(k, 'port', [0, 22, 443, 3389]), 'protocol' : 'TCP' }} AS port,
+                ago(k, 'first', 60) AS first_found,
+                ago(k, 'last', 40) AS last_found,
+                {{
+                    'id' : 10000 + hash(k, 'plugin') % 90000,
+                    'name' : 'Plugin ' || hash(k, 'plugin') % 90000,
+                    'publication_date' : ago(k, 'publication', 90),
+                    'cve' : [ 'CVE-2024-' || (1000 + hash(k, 'cve') % 9000) ],
+                    'exploit_available' : rnd(k, 'exploit') < 0.5,
+                    'has_patch' : rnd(k, 'patch') < 0.5,
+                    'family' : pick(k, 'family', ['Windows', 'General']),
+                    'cvss3_base_score' : round(rnd(k, 'cvss') * 10, 1)
+                }} AS plugin
+            FROM (SELECT i, i * 7 + unnest(range(CAST(hash(i, 'tio_n') % 7 AS BIGINT))) AS k FROM range({hosts}) t(i))""",
+        'okta_users' : f"""
+            SELECT
+                md5(i || 'okta') AS id,
+                pick(i, 'status', ['ACTIVE', 'ACTIVE', 'SUSPENDED', 'DEPROVISIONED']) AS status,
+                ago(i, 'created', 900) AS created,
+                ago(i, 'created', 900) AS activated,
+                ago(i, 'changed', 60) AS status_changed,
+                ago(i, 'login', 120) AS last_login,
+                ago(i, 'updated', 30) AS last_updated,
+                ago(i, 'password', 200) AS password_changed,
+                {{ 'id' : 'oty' || md5('default') }} AS type,
+                {{
+                    'login' : 'user' || i || '@example.com',
+                    'first_name' : 'First' || i,
+                    'last_name' : 'Last' || i,
+                    'display_name' : 'First' || i || ' Last' || i,
+                    'email' : 'user' || i || '@example.com',
+                    'user_type' : pick(i, 'user_type', ['Employee', 'Contractor']),
+                    'organization' : 'Example',
+                    'title' : pick(i, 'title', ['Engineer', 'Analyst', 'Manager']),
+                    'division' : pick(i, 'division', ['Corp', 'Retail']),
+                    'department' : pick(i, 'department', ['IT', 'Finance', 'HR']),
+                    'cost_center' : 'CC' || (hash(i, 'cost_center') % 50),
+                    'employee_number' : CAST(100000 + i AS VARCHAR),
+                    'city' : pick(i, 'city', ['Sydney', 'Melbourne', 'London']),
+                    'country_code' : pick(i, 'country', ['AU', 'AU', 'GB'])
+                }} AS profile
+            FROM range({users}) t(i)""",
+        'knowbe4_enrollments' : f"""
+            SELECT
+                hash(i, 'enrollment') % 100000000 AS enrollment_id,
+                'Annual Security Awareness' AS campaign_name,
+                pick(i, 'module', ['Phishing Basics', 'Passwords', 'Social Engineering']) AS module_name,
+                {{ 'id' : i, 'first_name' : 'First' || i, 'last_name' : 'Last' || i, 'email' : 'user' || i || '@example.com' }} AS user,
+                ago(i, 'enrolled_on', 500) AS enrollment_date,
+                ago(i, 'completed', 400) AS completion_date,
+                pick(i, 'kb4_status', ['Passed', 'Passed', 'In Progress', 'Not Started']) AS status,
+                hash(i, 'kb4_time') % 3600 AS time_spent
+            FROM range({users}) t(i)
+            WHERE rnd(i, 'enrolled') < 0.8""",
+        'snyk_organizations' : f"""
+            SELECT
+                md5(i || 'snyk_org') AS id,
+                'org' AS type,
+                {{ 'name' : 'Org ' || i, 'slug' : 'org-' || i, 'is_personal' : false }} AS attributes
+            FROM range({orgs}) t(i)""",
+        'snyk_members' : f"""
+            SELECT
+                md5(i || 'snyk_member') AS id,
+                'Member ' || i AS name,
+                'member' || i AS username,
+                'member' || i || '@example.com' AS email,
+                pick(i, 'snyk_role', ['collaborator', 'collaborator', 'admin']) AS role
+            FROM range({orgs * 10}) t(i)""",
+        'snyk_projects' : f"""
+            SELECT
+                md5(i || 'snyk') AS id,
+                'project' AS type,
+                {{
+                    'name' : 'repo' || i,
+                    'target_file' : 'package.json',
+                    'type' : pick(i, 'snyk_type', ['npm', 'pip', 'maven']),
+                    'origin' : 'github',
+                    'status' : 'active',
+                    'created' : ago(i, 'snyk_created', 700)
+                }} AS attributes,
+                {{ 'organization' : {{ 'data' : {{ 'id' : md5((i % {orgs}) || 'snyk_org'), 'type' : 'org' }} }} }} AS relationships
+            FROM range({projects}) t(i)""",
+        'snyk_issues' : f"""
+            SELECT
+                md5((i * 3 + j) || 'snyk_issue') AS id,
+                'issue' AS type,
+                {{ 'scan_item' : {{ 'data' : {{ 'id' : md5(i || 'snyk'), 'type' : 'project' }} }} }} AS relationships,
+                {{
+                    'status' : 'open',
+                    'effective_severity_level' : pick(i * 3 + j, 'severity', ['low', 'high', 'critical']),
+                    'title' : pick(i * 3 + j, 'snyk_title', ['Prototype Pollution', 'Regular Expression Denial of Service', 'Remote Code Execution']),
+                    'type' : 'package_vulnerability',
+                    'created_at' : ago(i * 3 + j, 'snyk_issue_created', 200),
+                    'ignored' : false
+                }} AS attributes
+            FROM range({projects}) t(i), range(3) s(j)""",
+        'domains' : f"""
+            SELECT
+                'd' || i || '.com' AS domain,
+                CAST(anchor() AS DATE) + CAST(hash(i, 'expires') % 410 AS INTEGER) - 10 AS expiration_date,
+                ago(i, 'domain_updated', 300) AS updated_date,
+                ago(i, 'domain_created', 5000) AS creation_date,
+                [ 'NS1.EXAMPLE.NET', 'NS2.EXAMPLE.NET' ] AS name_servers,
+                CASE WHEN rnd(i, 'spf') < 0.7 THEN [ 'v=spf1 -all' ] ELSE [] END || CASE WHEN rnd(i, 'dmarc') < 0.4 THEN [ 'v=DMARC1; p=reject' ] ELSE [] END AS txt,
+                CASE WHEN rnd(i, 'mx') < 0.7 THEN [ 'mx.d' || i || '.com' ] ELSE [] END AS mx,
+                {{
+                    'http' : {{ 'Server' : 'nginx', 'Location' : 'https://d' || i || '.com/' }},
+                    'https' : {{ 'Server' : 'nginx', 'Strict-Transport-Security' : CASE WHEN rnd(i, 'hsts') < 0.5 THEN 'max-age=31536000' END }}
+                }} AS headers
+            FROM range({domains}) t(i)""",
+        'okta_groups' : f"""
+            SELECT
+                md5(i || 'okta_group') AS id,
+                pick(i, 'group_type', ['OKTA_GROUP', 'APP_GROUP']) AS type,
+                ago(i, 'group_created', 900) AS created,
+                ago(i, 'group_updated', 90) AS last_updated,
+                ago(i, 'group_membership', 30) AS last_membership_updated,
+                {{ 'name' : 'Group ' || i, 'description' : 'Synthetic group ' || i }} AS profile
+            FROM range({groups}) t(i)""",
+        'okta_factors' : f"""
+            SELECT
+                md5(i || 'okta') AS user_id,
+                md5(i || 'factor' || j) AS id,
+                ['push', 'token:software:totp', 'sms'][j + 1] AS factor_type,
+                ['OKTA', 'GOOGLE', 'OKTA'][j + 1] AS provider,
+                ['OKTA', 'GOOGLE', 'OKTA'][j + 1] AS vendor_name,
+                'ACTIVE' AS status,
+                ago(i * 3 + j, 'factor_created', 500) AS created,
+                ago(i * 3 + j, 'factor_updated', 100) AS last_updated
+            FROM range({users}) t(i), range(3) s(j)
+            WHERE rnd(i * 3 + j, 'factor') < 0.6""",
+        'crowdstrike_zero_trust_assessment' : f"""
+            SELECT
+                md5(i || 'cs') AS aid,
+                md5(i || 'cid') AS cid,
+                strftime(ago(i, 'zta', 7), '%Y-%m-%dT%H:%M:%SZ') AS modified_time,
+                {{ 'overall' : hash(i, 'zta_overall') % 101, 'os' : hash(i, 'zta_os') % 101, 'sensor_config' : hash(i, 'zta_sensor') % 101, 'version' : '3.6.1' }} AS assessment
+            FROM range({hosts}) t(i)""",
+        'tenable_findings' : f"""
+            SELECT
+                {{ 'uuid' : md5(i || 'tio'), 'hostname' : 'host' || i }} AS asset,
+                md5(i || 'tio' || j) AS finding_id,
+                'CIS Benchmark ' || (1 + j) AS check_name,
+                'audit-' || j AS audit_file,
+                pick(i * 5 + j, 'compliance', ['PASSED', 'PASSED', 'FAILED', 'WARNING']) AS status,
+                ago(i * 5 + j, 'compliance_first', 60) AS first_seen,
+                ago(i * 5 + j, 'compliance_last', 10) AS last_seen
+            FROM range({hosts}) t(i), range(5) s(j)""",
+        'tenable_was' : f"""
+            SELECT
+                md5(i || 'was') AS finding_id,
+                'https://app' || (i % {apps}) || '.example.com/' AS url,
+                98000 + hash(i, 'was_plugin') % 1000 AS plugin_id,
+                pick(i, 'was_severity', ['info', 'low', 'medium', 'high', 'critical']) AS severity,
+                pick(i, 'was_state', ['ACTIVE', 'ACTIVE', 'FIXED']) AS state,
+                ago(i, 'was_first', 90) AS first_found,
+                ago(i, 'was_last', 10) AS last_found
+            FROM range({apps * 20}) t(i)"""
+    }
+
+def main(**KW):
+    lib = Library()
+    db = duckdb.connect()
+    date = datetime.date.fromisoformat(KW['date']).isoformat()
+    for m in MACROS:
+        db.execute(m.format(date = date))
+
+    # == the files are written where a collector would write them (%TAG/%TENANCY.json), and the row counts kept in manifest.json
+    manifest = { 'hosts' : KW['hosts'], 'date' : date, 'tables' : {} }
+    for tag,sql in tables(KW['hosts']).items():
+        start = time.time()
+        os.makedirs(f"{KW['data']}/{tag}",exist_ok = True)
+        target = f"{KW['data']}/{tag}/{lib.config['tenancy']}"
+        db.execute(f"CREATE OR REPLACE TABLE generated AS {sql}")
+        db.execute(f"COPY generated TO '{target}.json' (FORMAT json, ARRAY true)")
+        if KW.get('parquet'):
+            db.execute(f"COPY generated TO '{target}.parquet' (FORMAT parquet)")
+        elif os.path.exists(f"{target}.parquet"):
+            os.remove(f"{target}.parquet")
+        manifest['tables'][tag] = db.query("SELECT count(*) FROM generated").fetchone()[0]
+        logging.info(f"{tag} - {manifest['tables'][tag]} records in {time.time() - start:.1f}s")
+
+    with open(f"{KW['data']}/manifest.json",'wt',encoding='UTF-8') as q:
+        json.dump(manifest,q,indent = 2)
+    logging.info(f"Generated {sum(manifest['tables'].values())} records for {KW['hosts']} hosts in {KW['data']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cyber Dashboard - Synthetic source data')
+    parser.add_argument('-hosts',help='The number of hosts to generate (the other sources are scaled from it)',type=int,default=10000)
+    parser.add_argument('-data',help='The path to write the source data to',default='../data/benchmark/source')
+    parser.add_argument('-parquet',help='Write a parquet copy of every source as well',action='store_true')
+    parser.add_argument('-date',help='The reference date (YYYY-MM-DD) the generated dates are counted back from (today by default)',default=datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d'))
+
+    args = parser.parse_args()
+
+    main(
+        hosts   = args.hosts,
+        data    = args.data,
+        parquet = args.parquet,
+        date    = args.date
+    )
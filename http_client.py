@@ -0,0 +1,184 @@
+'''A shared HTTP client used by the collectors - connection pooling, rate limiting, retries and latency tracking'''
+import os
+import time
+import random
+import threading
+import email.utils
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+import logging
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+IDEMPOTENT = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+class TokenBucket:
+    def __init__(self,rate,burst = None):
+        self.rate = rate                    # tokens per second
+        self.burst = burst or max(rate,1)   # most tokens we can build up
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # == takes a token, and returns how long to wait before using it.  It does not sleep, so it works
+        # == for threads (time.sleep) and for asyncio (asyncio.sleep) alike.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+class Histogram:
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def observe(self,seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max,seconds)
+            for i,b in enumerate(self.BUCKETS):
+                if seconds <= b:
+                    self.counts[i] += 1
+                    break
+
+    def percentile(self,p):
+        # -- the upper bound of the bucket the percentile falls in
+        n = 0
+        for i,b in enumerate(self.BUCKETS):
+            n += self.counts[i]
+            if n >= self.count * p:
+                return min(b,self.max)
+        return self.max
+
+    def summary(self):
+        return f"{self.count} requests, avg {self.total / max(self.count,1):.2f}s, p50 <= {self.percentile(0.5):.2f}s, p95 <= {self.percentile(0.95):.2f}s, max {self.max:.2f}s"
+
+def backoff(attempt,retry_after = None,base = 1,cap = 60):
+    # == honour Retry-After (seconds, or an HTTP date) when we have it, otherwise exponential backoff with jitter
+    if retry_after:
+        try:
+            return min(cap,max(0,float(retry_after)))
+        except ValueError:
+            try:
+                return min(cap,max(0,email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return min(cap,base * 2 ** attempt) * random.uniform(0.5,1)
+
+def rate_limits():
+    # == HTTP_RATE_LIMITS="api.snyk.io=25;us.api.knowbe4.com=4" overrides the rate (requests per second) for a host
+    limits = {}
+    for r in os.environ.get('HTTP_RATE_LIMITS','').split(';'):
+        if '=' in r:
+            host,rate = r.split('=',1)
+            limits[host.strip()] = float(rate)
+    return limits
+
+def not_sent(e):
+    # -- we could not connect, so the request never reached the server
+    if isinstance(e,requests.exceptions.ConnectTimeout):
+        return True
+    return isinstance(getattr(e.args[0] if e.args else None,'reason',None),urllib3.exceptions.NewConnectionError)
+
+class HttpClient:
+    def __init__(self,rate = 0,retries = 5,timeout = 30,pool = 10,headers = None):
+        self.rate = rate            # default requests per second for each host, 0 for no limit
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool, pool_maxsize = pool)
+        self.session.mount('https://',adapter)
+        self.session.mount('http://',adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.limits = rate_limits()
+        self.buckets = {}
+        self.latency = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def host(self,url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.latency:
+                rate = self.limits.get(host,self.rate)
+                self.buckets[host] = TokenBucket(rate) if rate > 0 else None
+                self.latency[host] = Histogram()
+                self.errors[host] = 0
+        return host
+
+    def error(self,host):
+        with self.lock:
+            self.errors[host] += 1
+
+    def request(self,method,url,**KW):
+        # == a request that is not idempotent (like POST) is only sent again when we know the server did not act on
+        # == it - a 429, or a failure to connect.  Anything else could deliver it twice.
+        host = self.host(url)
+        KW.setdefault('timeout',self.timeout)
+        idempotent = method.upper() in IDEMPOTENT
+        for attempt in range(self.retries + 1):
+            if self.buckets[host]:
+                self.buckets[host].take()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method,url,**KW)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.latency[host].observe(time.monotonic() - start)
+                self.error(host)
+                if attempt == self.retries or not (idempotent or not_sent(e)):
+                    raise
+                wait = backoff(attempt)
+                logging.warning(f"{method} {url} - {e.__class__.__name__}, retrying in {wait:.1f}s")
+                time.sleep(wait)
+                continue
+            self.latency[host].observe(time.monotonic() - start)
+            if response.status_code not in RETRY_STATUS or attempt == self.retries or not (idempotent or response.status_code == 429):
+                return response
+            self.error(host)
+            wait = backoff(attempt,response.headers.get('Retry-After'))
+            logging.warning(f"{method} {url} - {response.status_code}, retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+    def get(self,url,**KW):
+        return self.request('GET',url,**KW)
+
+    def post(self,url,**KW):
+        return self.request('POST',url,**KW)
+
+    def report(self):
+        for host in sorted(self.latency):
+            logging.info(f"HTTP {host} - {self.latency[host].summary()}, {self.errors[host]} retried")
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+    # == a default client for the odd request (like Slack alerts), shared by the whole process
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(retries = 2, timeout = 10)
+        return _client
+
+def reset():
+    # == a forked process must not share the keep-alive sockets of its parent, so it starts with a client of its own.
+    # -- the lock is replaced too, as another thread of the parent may have held it when we forked
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
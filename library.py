@@ -1,14 +1,21 @@
 '''A common library used across the Automated Security Platform'''
 import os
 import datetime
-import requests
 import json
+import gzip
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+import threading
 import uuid
-import sys
+import http_client
 import logging
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 try:
     import colorama
     colorama.init()
@@ -38,6 +45,16 @@ formatter.datefmt = '%Y-%m-%d %H:%M:%S'
 handler.setFormatter(formatter)
 logging.basicConfig(level=logging.INFO, handlers=[handler])
 
+_s3_client = None
+_s3_lock = threading.Lock()
+
+# == the suffix, and the S3 Content-Encoding, of each STORE_COMPRESSION type
+COMPRESSION = {
+    'none'  : ('',      None),
+    'gzip'  : ('.gz',   'gzip'),
+    'zstd'  : ('.zst',  'zstd')
+}
+
 class Library:
     def __init__(self):
         self.config = {
@@ -48,9 +65,26 @@ class Library:
             "STORE_AWS_S3_BACKUP"   : os.environ.get('STORE_AWS_S3_BACKUP','backup/%TAG/%TENANCY.json'),
             "STORE_AWS_S3_KEY"      : os.environ.get('STORE_AWS_S3_KEY',''),
             "STORE_DUCKDB"          : os.environ.get('STORE_DUCKDB',''),
-            "STORE_AWS_S3_HISTORY"  : os.environ.get('STORE_AWS_S3_HISTORY','history')
+            "STORE_PARQUET"         : os.environ.get('STORE_PARQUET',''),
+            "STORE_STATE"           : os.environ.get('STORE_STATE','../data/state/%TAG/%TENANCY.json'),
+            "STORE_AWS_S3_STATE"    : os.environ.get('STORE_AWS_S3_STATE','state/%TAG/%TENANCY.json'),
+            "STORE_AWS_S3_HISTORY"  : os.environ.get('STORE_AWS_S3_HISTORY','history'),
+            "STORE_AWS_S3_PART_SIZE"    : int(os.environ.get('STORE_AWS_S3_PART_SIZE','64')),
+            "STORE_AWS_S3_CONCURRENCY"  : int(os.environ.get('STORE_AWS_S3_CONCURRENCY','10')),
+            "STORE_COMPRESSION"     : os.environ.get('STORE_COMPRESSION','none').lower()
         }
+        if self.config['STORE_COMPRESSION'] not in COMPRESSION:
+            logging.warning(f"Unknown STORE_COMPRESSION {self.config['STORE_COMPRESSION']} - not compressing")
+            self.config['STORE_COMPRESSION'] = 'none'
+        if self.config['STORE_COMPRESSION'] == 'zstd' and zstandard is None:
+            logging.warning("STORE_COMPRESSION is zstd, but the zstandard module is not installed - using gzip")
+            self.config['STORE_COMPRESSION'] = 'gzip'
         
+        # == column types that must not be left to JSON auto-detection
+        self.column_types = {
+            'crowdstrike_hosts' : { 'last_seen' : 'VARCHAR', 'device_id' : 'VARCHAR', 'hostname' : 'VARCHAR' }
+        }
+
         self.datetime = datetime.datetime.now(datetime.timezone.utc)
         self.datestamp = self.datetime.strftime('%Y-%m-%d')
 
@@ -65,7 +99,7 @@ class Library:
             icon = severity_icons.get(sev, '')
             message = f"{icon} {txt}" if icon else txt
             try:
-                x = requests.post(os.environ['SLACK_WEBHOOK'],data=json.dumps({ 'type': 'mrkdwn', 'text' : message }).encode('utf-8'),headers = {   
+                x = http_client.client().post(os.environ['SLACK_WEBHOOK'],data=json.dumps({ 'type': 'mrkdwn', 'text' : message }).encode('utf-8'),headers = {   
                     'Content-Type': 'application/json'})
                 logging.info(f"Slack Response Code: {x.status_code}")
             except Exception as e:
@@ -88,25 +122,81 @@ class Library:
             '%DD',self.datetime.strftime('%d')
         )
     
+    def compressed(self,file_name):
+        # == the name of a data file (local or in S3) once the configured compression is applied
+        if file_name == '':
+            return file_name
+        return file_name + COMPRESSION[self.config['STORE_COMPRESSION']][0]
+
+    def compression_of(self,file_name):
+        for c,(suffix,encoding) in COMPRESSION.items():
+            if suffix != '' and file_name.endswith(suffix):
+                return c
+        return 'none'
+
+    def open_data(self,file_name,mode = 'rb',compression = None):
+        # == opens a data file, compressed or not.  The compression comes from the file name unless we are told.
+        compression = compression or self.compression_of(file_name)
+        encoding = 'UTF-8' if 't' in mode else None
+        if compression == 'gzip':
+            return gzip.open(file_name,mode,compresslevel = 6,encoding = encoding)
+        if compression == 'zstd':
+            return zstandard.open(file_name,mode,encoding = encoding)
+        return open(file_name,mode,encoding = encoding)
+
+    def s3_args(self,key):
+        args = {'ACL': 'bucket-owner-full-control'}
+        encoding = COMPRESSION[self.compression_of(key)][1]
+        if encoding:
+            args['ContentEncoding'] = encoding
+        return args
+
+    def s3(self):
+        # == one S3 client per process, shared by every Library instance (boto3 clients are thread safe)
+        global _s3_client
+        with _s3_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client('s3')
+            return _s3_client
+
+    def transfer_config(self):
+        return TransferConfig(
+            multipart_threshold = self.config['STORE_AWS_S3_PART_SIZE'] * 1024 * 1024,
+            multipart_chunksize = self.config['STORE_AWS_S3_PART_SIZE'] * 1024 * 1024,
+            max_concurrency     = self.config['STORE_AWS_S3_CONCURRENCY']
+        )
+
+    def copy_in_s3(self,bucket,source,key):
+        logging.info(f"Copying s3://{bucket}/{source} --> s3://{bucket}/{key}")
+        try:
+            self.s3().copy({ 'Bucket' : bucket, 'Key' : source }, bucket, key, ExtraArgs={**self.s3_args(key), 'ContentType' : 'application/json', 'MetadataDirective' : 'REPLACE'}, Config=self.transfer_config())
+            logging.info("Copy complete.")
+            return True
+        except ClientError as e:
+            logging.error(e)
+            return False
+
     def backup_to_s3(self,file_name,bucket,key):
         if bucket != '' and bucket != None and key != '' and key != None and file_name != None and file_name != '':
             logging.info(f"bucket    = {bucket}")
             logging.info(f"key       = {key}")
             logging.info(f"file_name = {file_name}")
-            s3_client = boto3.client('s3')
+            s3_client = self.s3()
             if os.path.exists(file_name):    
                 try:
-                    s3_client.upload_file(file_name, bucket, key, ExtraArgs={'ACL': 'bucket-owner-full-control'})
-                    logging.info(f"Upload complete.")
+                    s3_client.upload_file(file_name, bucket, key, ExtraArgs=self.s3_args(key), Config=self.transfer_config())
+                    logging.info("Upload complete.")
+                    return True
                 except ClientError as e:
                     logging.error(e)
             else:
                 logging.warning(f"The file {file_name} does not exist, so we will try to grab it from S3")
                 try:
-                    s3_client.download_file(bucket, key, file_name)
+                    s3_client.download_file(bucket, key, file_name, Config=self.transfer_config())
                     logging.info(f"Downloaded from s3://{bucket}/{key} --> {file_name}")
                 except ClientError as e:
                     logging.error(e)
+        return False
 
     def upload_to_s3(self,file_name,bucket,key):
         logging.info(f"Bucket = {bucket} , key = {key}, file_name = {file_name} ...")
@@ -115,10 +205,10 @@ class Library:
         else:
             if bucket != None and bucket != '' and key != None and os.path.exists(file_name):
                 logging.info(f"Uploading {file_name} to s3://{bucket}/{key}")
-                s3_client = boto3.client('s3')
+                s3_client = self.s3()
                 try:
-                    s3_client.upload_file(file_name, bucket, key, ExtraArgs={'ACL': 'bucket-owner-full-control'})
-                    logging.info(f"Upload complete.")
+                    s3_client.upload_file(file_name, bucket, key, ExtraArgs=self.s3_args(key), Config=self.transfer_config())
+                    logging.info("Upload complete.")
                 except ClientError as e:
                     logging.error(e)
                     return False
@@ -126,6 +216,24 @@ class Library:
             else:
                 logging.warning("Not uploading to S3 because none of the variables are defined.")
 
+    def exists_in_s3(self,bucket,prefix):
+        # == is there at least one object whose key starts with the prefix?
+        try:
+            return self.s3().list_objects_v2(Bucket = bucket, Prefix = prefix, MaxKeys = 1).get('KeyCount',0) > 0
+        except ClientError as e:
+            logging.error(e)
+            return False
+
+    def list_s3(self,bucket,prefix):
+        # == the keys of every object whose key starts with the prefix
+        keys = []
+        try:
+            for page in self.s3().get_paginator('list_objects_v2').paginate(Bucket = bucket, Prefix = prefix):
+                keys += [ o['Key'] for o in page.get('Contents',[]) ]
+        except ClientError as e:
+            logging.error(e)
+        return keys
+
     def download_from_s3(self,bucket,key,target = 'blob',parameter = None):
         if bucket != '' and bucket != None and key != '' and key != None:
             logging.info(f"Bucket    = {bucket}")
@@ -133,10 +241,10 @@ class Library:
             logging.info(f"Target    = {target}")
             logging.info(f"Parameter = {parameter}")
 
-            s3_client = boto3.client('s3')
+            s3_client = self.s3()
             if target == 'file':
                 try:
-                    s3_client.download_file(bucket, key, parameter)
+                    s3_client.download_file(bucket, key, parameter, Config=self.transfer_config())
                     logging.info(f"Downloaded from s3://{bucket}/{key} --> {parameter}")
                     return True
                 except ClientError as e: